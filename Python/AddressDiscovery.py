@@ -0,0 +1,81 @@
+import ipaddress
+import os
+import socket
+try: import requests
+except ImportError: requests = None
+
+def local_interface_ip() -> str:
+    # Connecting a UDP socket only picks the outgoing interface, nothing is sent.
+    # Without any route the node still starts on loopback
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(('192.0.2.1', 9)) # TEST-NET-1, never routed anywhere
+        return probe.getsockname()[0]
+    except OSError: return '127.0.0.1'
+    finally: probe.close()
+
+def valid_ip(ip) -> bool:
+    if not isinstance(ip, str): return False
+    try: ipaddress.ip_address(ip); return True
+    except ValueError: return False
+
+def valid_port(port) -> bool:
+    return isinstance(port, int) and not isinstance(port, bool) and 0 < port < 65536
+
+class AddressDiscovery:
+    # Works out the address peers should reach us at without blocking startup.
+    # The first source that knows it wins: an explicitly configured address, the
+    # address cached on disk by the last run, the local interface. Afterwards
+    # peers report the address they see us from in their node info responses,
+    # once quorum different peers agree on a new address it replaces the old one.
+    # An http lookup service can be asked in the background with query_service
+    def __init__(self, configured=None, cache_path=None, quorum=2):
+        self.cache_path = cache_path
+        self.quorum = quorum
+        self.votes = {} # observed address -> peers that reported it
+        self.public_ip, self.source = configured, 'config'
+        if not configured:
+            self.public_ip, self.source = self.load_cache(), 'cache'
+        if not self.public_ip:
+            self.public_ip, self.source = local_interface_ip(), 'local'
+
+    def load_cache(self):
+        if not self.cache_path: return None
+        try:
+            with open(self.cache_path) as cache: ip = cache.read().strip()
+        except OSError: return None
+        return ip if valid_ip(ip) else None
+
+    def save_cache(self):
+        if not self.cache_path: return
+        temp_path = self.cache_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as cache: cache.write(self.public_ip + '\n')
+            os.replace(temp_path, self.cache_path)
+        except OSError: pass
+
+    def update(self, ip: str, source: str) -> bool:
+        # Returns True if the address changed, a configured address never does
+        if self.source == 'config' or not valid_ip(ip): return False
+        changed = ip != self.public_ip
+        self.public_ip, self.source = ip, source
+        self.votes.clear()
+        self.save_cache()
+        return changed
+
+    def observe(self, ip: str, reporter: str) -> bool:
+        if self.source == 'config' or not valid_ip(ip) or ip == self.public_ip: return False
+        if ipaddress.ip_address(ip).is_loopback and not ipaddress.ip_address(reporter).is_loopback: return False
+        reporters = self.votes.setdefault(ip, set())
+        reporters.add(reporter)
+        if len(self.votes) > 64: self.votes = {ip: reporters} # forget noise from single liars
+        return len(reporters) >= self.quorum and self.update(ip, 'peers')
+
+    def query_service(self, url='https://api.ipify.org', timeout=3.0):
+        # Blocking, run it on a thread. Returns the address or None
+        if requests is None or self.source in ('config', 'peers'): return None
+        try: ip = requests.get(url, timeout=timeout).content.decode('utf8').strip()
+        except (requests.RequestException, UnicodeDecodeError): return None
+        if not valid_ip(ip): return None
+        if self.source != 'peers': self.update(ip, 'service')
+        return ip
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+import time
+
+class Admission:
+    # Decides whether a peer may go on before anything it sent gets parsed: at
+    # most max_connections connections at once and max_per_peer per source ip,
+    # plus a token bucket per source ip refilled with rate tokens per second up
+    # to burst, every connection and every message takes one token. Sources in
+    # the optional Blocklist are turned away before anything else
+    def __init__(self, max_connections=512, max_per_peer=8, rate=50.0, burst=100.0, max_peers=65536, blocklist=None):
+        self.max_connections = max_connections
+        self.max_per_peer = max_per_peer
+        self.rate = rate
+        self.burst = burst
+        self.max_peers = max_peers
+        self.active = 0
+        self.active_per_peer = {} # ip -> open connections
+        self.buckets = OrderedDict() # ip -> [tokens, last refill], least recently active first
+        self.blocklist = blocklist
+        self.rejected = 0
+
+    def blocked(self, ip: str) -> bool:
+        if self.blocklist is None or ip not in self.blocklist: return False
+        self.rejected += 1; return True
+
+    def open_connection(self, ip: str) -> bool:
+        if self.blocked(ip): return False
+        if self.active >= self.max_connections or self.active_per_peer.get(ip, 0) >= self.max_per_peer or not self.allow(ip):
+            self.rejected += 1; return False
+        self.active += 1; self.active_per_peer[ip] = self.active_per_peer.get(ip, 0) + 1
+        return True
+
+    def close_connection(self, ip: str):
+        self.active -= 1
+        if self.active_per_peer[ip] > 1: self.active_per_peer[ip] -= 1
+        else: del self.active_per_peer[ip]
+
+    def allow(self, ip: str, cost=1.0) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            bucket = self.buckets[ip] = [self.burst, now]
+            if len(self.buckets) > self.max_peers: self.buckets.popitem(last=False)
+        else: self.buckets.move_to_end(ip)
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate); bucket[1] = now
+        if bucket[0] < cost: self.rejected += 1; return False
+        bucket[0] -= cost
+        return True
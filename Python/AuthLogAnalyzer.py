@@ -0,0 +1,185 @@
+import argparse
+from collections import deque
+import calendar
+import json
+import mmap
+import os
+import re
+import tempfile
+import time
+
+# sshd failures in syslog lines, classic "Oct 13 18:37:04 host sshd[1]: ..." or
+# ISO 8601 timestamps from rsyslog's high precision format
+FAILURE = re.compile(
+    rb'^(?P<stamp>(?P<month>[A-Z][a-z]{2}) +(?P<day>\d{1,2}) (?P<clock>\d\d:\d\d:\d\d)'
+    rb'|(?P<iso>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)\S*) \S+ sshd\[\d+\]: '
+    rb'(?:Failed \S+ for (?:invalid user )?.*?|Invalid user .*?'
+    rb'|(?:Connection closed|Disconnected) by (?:invalid |authenticating )?user .*?)'
+    rb' from (?P<ip>[0-9A-Fa-f:.]+) port \d+', re.M)
+MONTHS = {name.encode(): number for number, name in enumerate(calendar.month_abbr) if name}
+# (window in seconds, failures within it that get an ip blocked)
+DEFAULT_RULES = ((60, 5), (3600, 20), (86400, 50))
+MMAP_THRESHOLD = 1024 * 1024 # new data above this is memory mapped instead of read
+
+def write_atomically(path: str, data: bytes):
+    # Readers like the Blocklist watcher see the old or the new file, never half of one
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data); output.flush(); os.fsync(output.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path); raise
+
+class AuthLogAnalyzer:
+    # Tails log_path from where the last run stopped, counts sshd failures per ip
+    # over sliding windows and rewrites blocklist_path whenever an ip crosses
+    # one of the rules. Offset, inode, windows and blocks persist in state_path
+    def __init__(self, log_path: str, blocklist_path: str, state_path=None, rules=DEFAULT_RULES,
+            ban_seconds=None, include_paths=()):
+        self.log_path = log_path
+        self.blocklist_path = blocklist_path
+        self.state_path = state_path or blocklist_path + '.state'
+        self.rules = sorted(rules)
+        self.horizon = self.rules[-1][0]
+        self.ban_seconds = ban_seconds # None blocks for good
+        self.include_paths = include_paths # static entries copied into the blocklist
+        self.inode = None
+        self.offset = 0
+        self.failures = {} # ip -> deque of failure times within horizon
+        self.blocked = {} # ip -> blocked until (None = for good)
+        self.latest = 0.0 # newest log time seen, windows and bans run on log time
+        self.last_clock = (None, 0.0) # last parsed timestamp, consecutive lines mostly share it
+        self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as state_file: state = json.load(state_file)
+        except (OSError, ValueError): return
+        self.inode, self.offset = state['inode'], state['offset']
+        self.failures = {ip: deque(times) for ip, times in state['failures'].items()}
+        self.blocked = state['blocked']
+        self.latest = state['latest']
+
+    def save_state(self):
+        state = {'inode': self.inode, 'offset': self.offset, 'blocked': self.blocked, 'latest': self.latest,
+            'failures': {ip: list(times) for ip, times in self.failures.items()}}
+        write_atomically(self.state_path, json.dumps(state).encode())
+
+    def parse_time(self, match) -> float:
+        stamp = match.group('stamp')
+        if stamp == self.last_clock[0]: return self.last_clock[1]
+        if match.group('iso'):
+            when = calendar.timegm(time.strptime(match.group('iso').decode(), '%Y-%m-%dT%H:%M:%S'))
+        else:
+            month, day, hms = match.group('month', 'day', 'clock')
+            hours, minutes, seconds = hms.split(b':')
+            clock = (MONTHS[month], int(day), int(hours), int(minutes), int(seconds))
+            # Syslog has no year. Lines follow the newest one seen, so the year is the
+            # one putting the date within half a year of it: January after December
+            # rolls over, a late December line after January does not. Before any
+            # line, a date far in the future belongs to last year
+            if self.latest:
+                year = time.gmtime(self.latest).tm_year
+                when = calendar.timegm((year,) + clock)
+                if when < self.latest - 183 * 86400: when = calendar.timegm((year + 1,) + clock)
+                elif when > self.latest + 183 * 86400: when = calendar.timegm((year - 1,) + clock)
+            else:
+                when = calendar.timegm((time.gmtime().tm_year,) + clock)
+                if when > time.time() + 86400: when = calendar.timegm((time.gmtime().tm_year - 1,) + clock)
+        self.last_clock = (stamp, when)
+        return when
+
+    def record(self, ip: str, when: float) -> bool:
+        # Returns True if this failure got ip blocked. Blocked ips are not
+        # counted, their window starts over once the ban ends
+        if when > self.latest: self.latest = when
+        if ip in self.blocked:
+            until = self.blocked[ip]
+            if until is None or until > when: return False
+        times = self.failures.get(ip)
+        if times is None: times = self.failures[ip] = deque()
+        times.append(when)
+        while times[0] <= when - self.horizon: times.popleft()
+        for window, limit in self.rules:
+            if len(times) < limit: continue
+            # times are in log order, the limit-th newest failure decides the window
+            if times[-limit] > when - window:
+                self.blocked[ip] = None if self.ban_seconds is None else when + self.ban_seconds
+                del self.failures[ip]
+                return True
+        return False
+
+    def scan(self, data, start: int, end: int) -> bool:
+        changed = False
+        for match in FAILURE.finditer(data, start, end):
+            changed |= self.record(match.group('ip').decode(), self.parse_time(match))
+        return changed
+
+    def expire(self, now: float) -> bool:
+        # Forgets windows that ran out and bans that ended
+        for ip in [ip for ip, times in self.failures.items() if times[-1] <= now - self.horizon]: del self.failures[ip]
+        ended = [ip for ip, until in self.blocked.items() if until is not None and until <= now]
+        for ip in ended: del self.blocked[ip]
+        return bool(ended)
+
+    def poll(self) -> bool:
+        # Processes every complete line appended since the last poll, returns
+        # True if the blocklist changed. State is only saved when a line was read
+        try: log = open(self.log_path, 'rb')
+        except OSError: return False
+        changed = False; position = (self.inode, self.offset)
+        with log:
+            stat = os.fstat(log.fileno())
+            # A rotated or truncated log starts over from its beginning
+            if stat.st_ino != self.inode or stat.st_size < self.offset: self.inode, self.offset = stat.st_ino, 0
+            if stat.st_size > self.offset:
+                if stat.st_size - self.offset >= MMAP_THRESHOLD:
+                    with mmap.mmap(log.fileno(), stat.st_size, access=mmap.ACCESS_READ) as data:
+                        end = data.rfind(b'\n', self.offset) + 1
+                        if end: changed = self.scan(data, self.offset, end); self.offset = end
+                else:
+                    log.seek(self.offset); data = log.read(stat.st_size - self.offset)
+                    end = data.rfind(b'\n') + 1
+                    if end: changed = self.scan(data, 0, end); self.offset += end
+        changed |= self.expire(self.latest)
+        if changed or not os.path.exists(self.blocklist_path): self.write_blocklist()
+        if changed or (self.inode, self.offset) != position: self.save_state()
+        return changed
+
+    def write_blocklist(self):
+        lines = [f"# generated by AuthLogAnalyzer from {os.path.basename(self.log_path)}"]
+        for path in self.include_paths:
+            try:
+                with open(path) as include: lines.extend(line.rstrip('\n') for line in include)
+            except OSError: continue
+        lines.extend(sorted(self.blocked))
+        write_atomically(self.blocklist_path, ('\n'.join(lines) + '\n').encode())
+
+    def follow(self, interval=2.0):
+        while True:
+            self.poll()
+            time.sleep(interval)
+
+def parse_rule(rule: str) -> tuple:
+    window, limit = rule.split(':')
+    return int(window), int(limit)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain an ip blocklist from sshd failures in a syslog file")
+    parser.add_argument('log', help="syslog file to tail, e.g. /var/log/auth.log")
+    parser.add_argument('blocklist', help="blocklist to write, e.g. WebAppV2/bitchat/ips.txt")
+    parser.add_argument('--state', help="where offset and windows persist (default: <blocklist>.state)")
+    parser.add_argument('--rule', action='append', type=parse_rule, metavar='SECONDS:FAILURES',
+        help="block an ip with FAILURES failures within SECONDS, repeatable (default: 60:5 3600:20 86400:50)")
+    parser.add_argument('--ban', type=float, help="seconds an ip stays blocked (default: for good)")
+    parser.add_argument('--include', action='append', default=[], help="static blocklist entries to keep, repeatable")
+    parser.add_argument('--follow', action='store_true', help="keep tailing the log")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between polls with --follow")
+    args = parser.parse_args()
+
+    analyzer = AuthLogAnalyzer(args.log, args.blocklist, args.state, args.rule or DEFAULT_RULES, args.ban, args.include)
+    if args.follow: analyzer.follow(args.interval)
+    else:
+        analyzer.poll()
+        print(f"{len(analyzer.blocked)} ips blocked, {len(analyzer.failures)} ips within the window")
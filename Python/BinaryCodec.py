@@ -0,0 +1,167 @@
+import socket
+import struct
+
+# Payload: message code, request id (0 = none), then the fields of that message.
+# Ids travel as raw bytes, ips as 16 byte addresses (ipv4 mapped into ipv6),
+# ports as 2 bytes where 0 means the network's default port
+MESSAGE_HEADER = struct.Struct('!BI')
+COUNT = struct.Struct('!H')
+PORT = struct.Struct('!H')
+LENGTH = struct.Struct('!I')
+KEY_SIZE = 32 # stored values are keyed by their SHA-256
+IPV4_MAPPED = bytes(10) + b'\xff\xff'
+
+# (message, layout), the code of a message is its position in this list plus one.
+# V1 messages are camelCase, V2 messages snake_case
+MESSAGES = [
+    ('nodeInfoRequest', 'address'), ('nodeInfoResponse', 'address_seen'),
+    ('closestNodesRequest', 'address'), ('closestNodesResponse', 'contacts'),
+    ('node_info_request', 'address'), ('node_info_response', 'address_seen'),
+    ('closest_nodes_request', 'address'), ('closest_nodes_response', 'contacts'),
+    ('closest_nodes_batch_request', 'address_ids'), ('closest_nodes_batch_response', 'contact_lists'),
+    ('store_request', 'address_key_value'), ('store_response', 'flag'),
+    ('find_value_request', 'address_key'), ('find_value_response', 'value_or_contacts'),
+]
+MESSAGE_CODES = {name: code for code, (name, _) in enumerate(MESSAGES, start=1)}
+
+class CodecError(ValueError):
+    pass
+
+def pack_ip(ip: str) -> bytes:
+    try: return IPV4_MAPPED + socket.inet_pton(socket.AF_INET, ip)
+    except OSError: pass
+    try: return socket.inet_pton(socket.AF_INET6, ip)
+    except (OSError, TypeError): raise CodecError(f"{ip!r} is no ip address")
+
+def unpack_ip(packed: bytes) -> str:
+    if packed[:12] == IPV4_MAPPED: return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+class BinaryCodec:
+    # Encodes the messages listed in MESSAGES, everything else raises CodecError
+    # so the caller can fall back to JSON. V1 sends contacts as {cid: ip},
+    # V2 as (cid, ip) or (cid, ip, port), contact_dicts picks the form decode hands back
+    def __init__(self, id_bits: int, contact_dicts=False):
+        self.id_size = (id_bits + 7) // 8
+        self.contact_dicts = contact_dicts
+        self.contact = struct.Struct(f'!{self.id_size}s16sH') # fixed size contact record
+
+    def pack_id(self, cid: str) -> bytes:
+        try: packed = bytes.fromhex(cid)
+        except (ValueError, TypeError): raise CodecError(f"{cid!r} is no hex id")
+        if len(packed) != self.id_size: raise CodecError(f"{cid!r} is no {self.id_size} byte id")
+        return packed
+
+    def unpack_id(self, packed: bytes) -> str:
+        return packed.hex()
+
+    def pack_key(self, key: str) -> bytes:
+        try: packed = bytes.fromhex(key)
+        except (ValueError, TypeError): raise CodecError(f"{key!r} is no hex key")
+        if len(packed) != KEY_SIZE: raise CodecError(f"{key!r} is no {KEY_SIZE} byte key")
+        return packed
+
+    def pack_contact(self, contact) -> bytes:
+        if isinstance(contact, dict): (cid, ip), port = next(iter(contact.items())), None
+        else: cid, ip, port = contact if len(contact) > 2 else (*contact, None)
+        return self.contact.pack(self.pack_id(cid), pack_ip(ip), port or 0)
+
+    def unpack_contacts(self, payload: bytes, offset: int) -> tuple:
+        (count,) = COUNT.unpack_from(payload, offset); offset += COUNT.size
+        end = offset + count * self.contact.size
+        if end > len(payload): raise CodecError("malformed binary message: truncated contacts")
+        records = self.contact.iter_unpack(payload[offset:end])
+        if self.contact_dicts: contacts = [{cid.hex(): unpack_ip(ip)} for cid, ip, _ in records]
+        else: contacts = [[cid.hex(), unpack_ip(ip), port] if port else [cid.hex(), unpack_ip(ip)] for cid, ip, port in records]
+        return contacts, end
+
+    def unpack_data(self, payload: bytes, offset: int) -> tuple:
+        (length,) = LENGTH.unpack_from(payload, offset); offset += LENGTH.size
+        if offset + length > len(payload): raise CodecError("malformed binary message: truncated value")
+        return payload[offset:offset + length].decode(), offset + length
+
+    def pack_contacts(self, contacts: list) -> bytes:
+        return COUNT.pack(len(contacts)) + b''.join(self.pack_contact(contact) for contact in contacts)
+
+    def encode(self, message: dict) -> bytes:
+        fields = {key: value for key, value in message.items() if key != 'requestID'}
+        if len(fields) != 1: raise CodecError("a message has exactly one field")
+        name, value = next(iter(fields.items()))
+        code = MESSAGE_CODES.get(name)
+        if code is None: raise CodecError(f"no binary layout for {name}")
+        layout = MESSAGES[code - 1][1]
+        try:
+            header = MESSAGE_HEADER.pack(code, message.get('requestID') or 0)
+            if layout == 'address': # the port a V2 node listens on is optional
+                ip, cid, port = value if len(value) > 2 else (*value, None)
+                return header + pack_ip(ip) + self.pack_id(cid) + PORT.pack(port or 0)
+            if layout == 'address_seen': # plus the address the responder saw the request come from
+                ip, cid, seen = value
+                return header + pack_ip(ip) + self.pack_id(cid) + pack_ip(seen)
+            if layout == 'contacts':
+                return header + self.pack_contacts(value)
+            if layout == 'address_ids':
+                ip, cids = value
+                return header + pack_ip(ip) + COUNT.pack(len(cids)) + b''.join(map(self.pack_id, cids))
+            if layout in ('address_key', 'address_key_value'):
+                ip, cid, key, *data = value
+                packed = header + pack_ip(ip) + self.pack_id(cid) + self.pack_key(key)
+                if layout == 'address_key': return packed
+                data = data[0].encode()
+                return packed + LENGTH.pack(len(data)) + data
+            if layout == 'flag':
+                return header + (b'\1' if value else b'\0')
+            if layout == 'value_or_contacts': # a value if the node holds it, closer contacts otherwise
+                if 'value' not in value: return header + b'\0' + self.pack_contacts(value['nodes'])
+                data = value['value'].encode()
+                return header + b'\1' + LENGTH.pack(len(data)) + data
+            return header + COUNT.pack(len(value)) + b''.join(
+                self.pack_id(cid) + self.pack_contacts(contacts) for cid, contacts in value.items())
+        except (struct.error, ValueError, TypeError, AttributeError, KeyError, StopIteration) as error:
+            raise CodecError(f"{name} does not fit its binary layout: {error}")
+
+    def decode(self, payload: bytes) -> dict:
+        try:
+            code, request_id = MESSAGE_HEADER.unpack_from(payload)
+            if not 0 < code <= len(MESSAGES): raise CodecError(f"unknown message code {code}")
+            name, layout = MESSAGES[code - 1]
+            offset = MESSAGE_HEADER.size
+            if layout in ('address', 'address_seen'):
+                value = [unpack_ip(payload[offset:offset + 16]), self.unpack_id(payload[offset + 16:offset + 16 + self.id_size])]
+                offset += 16 + self.id_size
+                if layout == 'address_seen': value.append(unpack_ip(payload[offset:offset + 16])); offset += 16
+                else:
+                    (port,) = PORT.unpack_from(payload, offset); offset += PORT.size
+                    if port: value.append(port)
+            elif layout == 'contacts':
+                value, offset = self.unpack_contacts(payload, offset)
+            elif layout == 'address_ids':
+                ip = unpack_ip(payload[offset:offset + 16]); offset += 16
+                (count,) = COUNT.unpack_from(payload, offset); offset += COUNT.size
+                cids = [self.unpack_id(payload[offset + i * self.id_size:offset + (i + 1) * self.id_size]) for i in range(count)]
+                value = [ip, cids]; offset += count * self.id_size
+            elif layout in ('address_key', 'address_key_value'):
+                value = [unpack_ip(payload[offset:offset + 16]), self.unpack_id(payload[offset + 16:offset + 16 + self.id_size])]
+                offset += 16 + self.id_size
+                value.append(payload[offset:offset + KEY_SIZE].hex()); offset += KEY_SIZE
+                if layout == 'address_key_value':
+                    data, offset = self.unpack_data(payload, offset); value.append(data)
+            elif layout == 'flag':
+                value = payload[offset:offset + 1] == b'\1'; offset += 1
+            elif layout == 'value_or_contacts':
+                has_value = payload[offset:offset + 1] == b'\1'; offset += 1
+                if has_value: data, offset = self.unpack_data(payload, offset); value = {'value': data}
+                else: nodes, offset = self.unpack_contacts(payload, offset); value = {'nodes': nodes}
+            else:
+                (count,) = COUNT.unpack_from(payload, offset); offset += COUNT.size
+                value = {}
+                for _ in range(count):
+                    cid = self.unpack_id(payload[offset:offset + self.id_size]); offset += self.id_size
+                    value[cid], offset = self.unpack_contacts(payload, offset)
+        except CodecError: raise
+        except (struct.error, ValueError) as error:
+            raise CodecError(f"malformed binary message: {error}")
+        if offset != len(payload): raise CodecError("malformed binary message: trailing bytes")
+        message = {name: value}
+        if request_id: message['requestID'] = request_id
+        return message
@@ -0,0 +1,97 @@
+from array import array
+from bisect import bisect_right
+import ipaddress
+import os
+import socket
+from threading import Thread
+import time
+
+IPV4_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+class IntervalSet:
+    # Sorted, merged [start, end] address ranges, a lookup is one binary search
+    def __init__(self, ranges, typecode):
+        starts, ends = [], []
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1] + 1: ends[-1] = max(ends[-1], end)
+            else: starts.append(start); ends.append(end)
+        # 32 bit ranges fit into a flat array, 128 bit ones stay python ints
+        self.starts = array(typecode, starts) if typecode else starts
+        self.ends = array(typecode, ends) if typecode else ends
+
+    def __contains__(self, address: int) -> bool:
+        i = bisect_right(self.starts, address) - 1
+        return i >= 0 and address <= self.ends[i]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+def parse_ipv4_range(token: str):
+    # Fast path for the common a.b.c.d[/n] entries, ipaddress is far slower
+    ip, _, prefix = token.partition('/')
+    try:
+        address = int.from_bytes(socket.inet_aton(ip), 'big') if ip.count('.') == 3 else None
+        prefix = int(prefix) if prefix else 32
+    except (OSError, ValueError): return None
+    if address is None or not 0 <= prefix <= 32: return None
+    host_bits = (1 << (32 - prefix)) - 1
+    return address & ~host_bits, address | host_bits
+
+def parse_blocklist(path: str) -> tuple:
+    # Every token that is an ip or a CIDR range counts, so plain lists and
+    # "count ip" tallies both work. Returns (ipv4 IntervalSet, ipv6 IntervalSet)
+    ranges = {4: [], 6: []}
+    with open(path) as blocklist:
+        for line in blocklist:
+            for token in line.split('#', 1)[0].split():
+                parsed = parse_ipv4_range(token) if ':' not in token else None
+                if parsed: ranges[4].append(parsed); continue
+                try: network = ipaddress.ip_network(token, strict=False)
+                except ValueError: continue
+                ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+    return IntervalSet(ranges[4], IPV4_TYPECODE), IntervalSet(ranges[6], None)
+
+class Blocklist:
+    # Addresses and CIDR ranges read from path, reloaded by a watcher thread
+    # whenever the file changes. A missing file blocks nothing
+    def __init__(self, path: str, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.version = None # (mtime, size, inode) of the loaded file
+        self.ranges = (IntervalSet((), IPV4_TYPECODE), IntervalSet((), None)) # (ipv4, ipv6)
+        self.reload_if_changed()
+
+    def reload_if_changed(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+            version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if version == self.version: return False
+            ranges = parse_blocklist(self.path)
+        except OSError:
+            if self.version is None: return False
+            version, ranges = None, (IntervalSet((), IPV4_TYPECODE), IntervalSet((), None))
+        # One assignment swaps both sets, readers never see half a reload
+        self.ranges = ranges
+        self.version = version
+        return True
+
+    def watch_forever(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.reload_if_changed()
+
+    def start_watching(self):
+        Thread(target=self.watch_forever, daemon=True).start()
+        return self
+
+    def __contains__(self, ip: str) -> bool:
+        ipv4, ipv6 = self.ranges
+        try: return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big') in ipv4
+        except OSError: pass
+        try: address = ipaddress.IPv6Address(ip.split('%', 1)[0])
+        except ValueError: return False
+        if address.ipv4_mapped: return int(address.ipv4_mapped) in ipv4
+        return int(address) in ipv6
+
+    def __len__(self) -> int:
+        return len(self.ranges[0]) + len(self.ranges[1])
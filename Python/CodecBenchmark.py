@@ -0,0 +1,33 @@
+import json
+import os
+import random
+import timeit
+from BinaryCodec import BinaryCodec
+
+# Encode/decode throughput and bytes on the wire of a FIND_NODE response with
+# k=20 contacts, JSON as V1 used to send it (indent=4), compact JSON and binary
+def random_ip() -> str:
+    return '.'.join(str(random.randint(1, 254)) for _ in range(4))
+
+def find_node_response(id_bits: int, contact_dicts: bool, k=20) -> dict:
+    contacts = [(os.urandom(id_bits // 8).hex(), random_ip()) for _ in range(k)]
+    if contact_dicts: return {'closestNodesResponse': [{cid: ip} for cid, ip in contacts], 'requestID': 1}
+    return {'closest_nodes_response': [list(contact) for contact in contacts]}
+
+def benchmark(name: str, message: dict, codec: BinaryCodec, rounds=20000):
+    encoders = {
+        'json indent=4': (lambda: json.dumps(message, indent=4).encode("utf-8"), lambda data: json.loads(data)),
+        'json': (lambda: json.dumps(message).encode("utf-8"), lambda data: json.loads(data)),
+        'binary': (lambda: codec.encode(message), codec.decode),
+    }
+    print(f"{name}:")
+    for label, (encode, decode) in encoders.items():
+        data = encode()
+        assert decode(data) == json.loads(json.dumps(message))
+        encode_time = timeit.timeit(encode, number=rounds) / rounds
+        decode_time = timeit.timeit(lambda: decode(data), number=rounds) / rounds
+        print(f"  {label:14} {len(data):6} bytes  encode {encode_time * 1e6:7.2f} us  decode {decode_time * 1e6:7.2f} us")
+
+if __name__ == '__main__':
+    benchmark("V1 FIND_NODE response, 160 bit ids", find_node_response(160, True), BinaryCodec(160, contact_dicts=True))
+    benchmark("V2 FIND_NODE response, 16 bit ids", find_node_response(16, False), BinaryCodec(16))
@@ -0,0 +1,92 @@
+import asyncio
+from collections import deque
+import socket
+import threading
+import time
+
+class ConnectionPool:
+    # Keeps finished connections open per peer so the next request skips the
+    # TCP handshake. At most max_connections are open at once, idle ones beyond
+    # max_idle_per_peer or older than idle_timeout get closed
+    def __init__(self, max_connections=256, max_idle_per_peer=2, idle_timeout=60.0):
+        self.max_connections = max_connections
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle_timeout = idle_timeout
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle = {} # (host, port) -> deque of (reader, writer, released at)
+        self.open = set() # writers holding a slot
+
+    async def acquire(self, host: str, port: int, timeout=5.0) -> tuple:
+        # Returns (reader, writer, reused)
+        idle = self.idle.get((host, port))
+        while idle:
+            reader, writer, _ = idle.pop()
+            if self.healthy(reader, writer): return reader, writer, True
+            self.discard(writer)
+        if self.slots.locked(): self.evict_oldest()
+        await asyncio.wait_for(self.slots.acquire(), timeout)
+        try: reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except BaseException: self.slots.release(); raise
+        self.open.add(writer)
+        return reader, writer, False
+
+    def release(self, host: str, port: int, reader, writer, reusable=True):
+        idle = self.idle.setdefault((host, port), deque())
+        if reusable and len(idle) < self.max_idle_per_peer and self.healthy(reader, writer):
+            idle.append((reader, writer, time.monotonic()))
+        else: self.discard(writer)
+
+    def healthy(self, reader, writer) -> bool:
+        return not writer.is_closing() and not reader.at_eof()
+
+    def discard(self, writer):
+        if writer in self.open:
+            self.open.discard(writer); self.slots.release()
+        writer.close()
+
+    def evict_oldest(self):
+        oldest = min(((idle[0][2], key) for key, idle in self.idle.items() if idle), default=None)
+        if oldest: self.discard(self.idle[oldest[1]].popleft()[1])
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for key, idle in list(self.idle.items()):
+            while idle and idle[0][2] < deadline: self.discard(idle.popleft()[1])
+            if not idle: del self.idle[key]
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.evict_idle()
+
+    def close(self):
+        for idle in self.idle.values():
+            while idle: self.discard(idle.popleft()[1])
+
+class SocketPool:
+    # Connection cap for the threaded V1 node. V1 keeps one long lived request
+    # channel per peer instead of idle sockets, so this only hands out fresh
+    # sockets while fewer than max_connections are open, idle_timeout is how
+    # long V1 leaves an unused channel open
+    def __init__(self, max_connections=256, idle_timeout=60.0):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.open = set()
+        self.lock = threading.Lock()
+
+    def acquire(self, host: str, port: int, timeout=5.0) -> socket.socket:
+        if not self.slots.acquire(timeout=timeout): raise TimeoutError("connection pool exhausted")
+        try: client = socket.create_connection((host, port), timeout=timeout)
+        except BaseException: self.slots.release(); raise
+        with self.lock: self.open.add(client)
+        return client
+
+    def full(self) -> bool:
+        with self.lock: return len(self.open) >= self.max_connections
+
+    def discard(self, client: socket.socket):
+        with self.lock:
+            if client in self.open:
+                self.open.discard(client); self.slots.release()
+        client.close()
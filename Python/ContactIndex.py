@@ -0,0 +1,57 @@
+import numpy as np
+from RoutingTable import NodeContact
+
+class ContactIndex:
+    # Array backed contact store for crawler and bootstrap nodes, ids are kept
+    # left aligned in uint64 columns so the first column decides most ranks
+    def __init__(self, id_bits: int, capacity=1024):
+        self.id_bits = id_bits
+        self.words = (id_bits + 63) // 64
+        self.padding = self.words * 64 - id_bits
+        self.ids = np.zeros((capacity, self.words), dtype=np.uint64)
+        self.contacts = [] # row -> NodeContact
+        self.rows = {} # id -> row
+
+    def split_id(self, node_id: int) -> np.ndarray:
+        aligned = node_id << self.padding
+        return np.array([(aligned >> (64 * (self.words - 1 - i))) & 0xFFFFFFFFFFFFFFFF
+            for i in range(self.words)], dtype=np.uint64)
+
+    def add_contact(self, contact: NodeContact):
+        row = self.rows.get(contact.id)
+        if row is not None: self.contacts[row] = contact; return
+        if len(self.contacts) == len(self.ids):
+            grown = np.zeros((max(len(self.ids), 1), self.words), dtype=np.uint64)
+            self.ids = np.concatenate((self.ids, grown))
+        self.ids[len(self.contacts)] = self.split_id(contact.id)
+        self.rows[contact.id] = len(self.contacts)
+        self.contacts.append(contact)
+
+    def remove_contact(self, node_id: int):
+        row = self.rows.pop(node_id, None)
+        if row is None: return
+        # Move the last row into the gap so the arrays stay dense
+        last = self.contacts.pop()
+        if row < len(self.contacts):
+            self.ids[row] = self.ids[len(self.contacts)]
+            self.contacts[row] = last
+            self.rows[last.id] = row
+
+    def closest(self, target: int, amount: int) -> list:
+        count = len(self.contacts)
+        if count == 0 or amount <= 0: return []
+        distances = np.bitwise_xor(self.ids[:count], self.split_id(target))
+        candidates = np.arange(count)
+        if count > amount:
+            # Only rows tying with the amount-th first column can still rank
+            first = distances[:, 0]
+            kth = first[np.argpartition(first, amount - 1)[amount - 1]]
+            candidates = np.flatnonzero(first <= kth)
+        order = np.lexsort(distances[candidates].T[::-1])[:amount]
+        return [self.contacts[row] for row in candidates[order]]
+
+    def __contains__(self, node_id: int) -> bool:
+        return node_id in self.rows
+
+    def __len__(self) -> int:
+        return len(self.contacts)
@@ -0,0 +1,110 @@
+import asyncio
+import random
+import socket
+import time
+from Protocol import encode_message, decode_frame, decode_message, FRAME_BINARY
+
+# Fits into one datagram on every path without IP fragmentation
+MAX_DATAGRAM_SIZE = 1200
+SOCKET_BUFFER_SIZE = 1024 * 1024
+
+class DatagramTooLarge(Exception):
+    pass
+
+class DatagramRPC(asyncio.DatagramProtocol):
+    # Small requests and their replies travel as single datagrams carrying a
+    # request id. A lost datagram is sent again after a doubled timer, all
+    # attempts together take at most the request's timeout. Replies
+    # that do not fit into a datagram are answered with datagram_too_large so
+    # the caller can repeat the request over TCP. Replies are the *_response
+    # messages, everything else is handed to handler(message, peer ip) -> reply or None.
+    # Sources are spoofable, so requests in stream_only and requests whose
+    # reply_size(message) already exceeds a datagram are refused unhandled
+    def __init__(self, handler, codec=None, max_datagram_size=MAX_DATAGRAM_SIZE, max_in_flight=256, admission=None,
+            stream_only=(), reply_size=None):
+        self.handler = handler
+        self.codec = codec
+        self.max_datagram_size = max_datagram_size
+        self.admission = admission # Admission checked before a request gets decoded
+        self.stream_only = stream_only
+        self.reply_size = reply_size # message -> bytes its reply takes at least, known without building it
+        self.transport = None
+        self.pending = {} # request id -> (address, future)
+        self.pending_peers = {} # address -> requests awaiting its reply, those are never rate limited
+        self.sending = None # request id of the datagram inside transport.sendto
+        # Bursts beyond the socket buffers would only be dropped and retransmitted
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        udp_socket = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try: udp_socket.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+            except OSError: pass
+
+    def connection_lost(self, exc):
+        for _, future in self.pending.values():
+            if not future.done(): future.set_exception(ConnectionError("datagram endpoint closed"))
+
+    def error_received(self, exc):
+        # An unconnected socket only reports failed sends, which happen inside
+        # transport.sendto, so the error belongs to the datagram being sent
+        waiting = self.pending.get(self.sending)
+        if waiting and not waiting[1].done(): waiting[1].set_exception(ConnectionError(f"datagram not sent: {exc}"))
+
+    def datagram_received(self, data: bytes, address: tuple):
+        if self.admission and (self.admission.blocked(address[0]) or
+            address[:2] not in self.pending_peers and not self.admission.allow(address[0])): return
+        try:
+            kind, payload = decode_frame(data)
+            message = decode_message(kind, payload, self.codec)
+            request_id = message.pop('requestID', None)
+            name = next(iter(message))
+        except (ValueError, StopIteration, AttributeError, TypeError): return
+        if name.endswith('_response') or name == 'datagram_too_large':
+            waiting = self.pending.get(request_id)
+            if waiting and waiting[0] == address[:2] and not waiting[1].done(): waiting[1].set_result(message)
+            return
+        codec = self.codec if kind == FRAME_BINARY else None
+        too_large = encode_message({'datagram_too_large': True, 'requestID': request_id}, codec)
+        try:
+            if name in self.stream_only or self.reply_size and self.reply_size(message) > self.max_datagram_size:
+                self.transport.sendto(too_large, address); return
+            reply = self.handler(message, address[0])
+        except (ValueError, KeyError, TypeError, IndexError, AttributeError): return
+        if reply is None: return
+        datagram = encode_message(dict(reply, requestID=request_id), codec)
+        self.transport.sendto(datagram if len(datagram) <= self.max_datagram_size else too_large, address)
+
+    async def request(self, address: tuple, message: dict, timeout=5.0, retries=2) -> tuple:
+        # Returns (reply, round trip time). Only an answer to the first datagram
+        # yields a usable round trip time, later ones report None (Karn)
+        async with self.in_flight:
+            return await self.send_request(address, message, timeout, retries)
+
+    async def send_request(self, address: tuple, message: dict, timeout: float, retries: int) -> tuple:
+        request_id = random.getrandbits(32) or 1
+        while request_id in self.pending: request_id = random.getrandbits(32) or 1
+        datagram = encode_message(dict(message, requestID=request_id), self.codec)
+        if len(datagram) > self.max_datagram_size: raise DatagramTooLarge(f"{len(datagram)} byte request")
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (address[:2], future)
+        self.pending_peers[address[:2]] = self.pending_peers.get(address[:2], 0) + 1
+        first_timer = timeout / (2 ** (retries + 1) - 1)
+        try:
+            for attempt in range(retries + 1):
+                self.sending = request_id
+                try: self.transport.sendto(datagram, address)
+                finally: self.sending = None
+                started = time.monotonic()
+                try: reply = await asyncio.wait_for(asyncio.shield(future), first_timer * 2 ** attempt)
+                except asyncio.TimeoutError:
+                    if attempt == retries: raise
+                    continue
+                if 'datagram_too_large' in reply: raise DatagramTooLarge("reply does not fit into a datagram")
+                return reply, time.monotonic() - started if attempt == 0 else None
+        finally:
+            del self.pending[request_id]
+            if self.pending_peers[address[:2]] > 1: self.pending_peers[address[:2]] -= 1
+            else: del self.pending_peers[address[:2]]
+            if not future.done(): future.cancel()
@@ -1,179 +1,304 @@
-import socket
-import requests
-import json
+import argparse
 import time
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED, TimeoutError as FutureTimeout
 import hashlib
 import os
 import random
+from RoutingTable import RoutingTable, NodeContact, load_snapshot
+from NodeLookup import Shortlist, LookupCache
+from ConnectionPool import SocketPool
+from Protocol import choose_codec, CODECS, MAX_FRAME_SIZE
+from BinaryCodec import BinaryCodec
+from RequestChannel import RequestChannel
+from SelectorServer import SelectorServer
+from Admission import Admission
+from Blocklist import Blocklist
+from AddressDiscovery import AddressDiscovery, local_interface_ip
+
+# What a dead, slow or misbehaving peer can raise, a lookup skips the peer
+RPC_ERRORS = (OSError, KeyError, ValueError, TypeError, IndexError, AttributeError)
 
 class Node:
-    def __init__(self, port:int, bootstrapNodes:list):
-        # initialize the network
-        self.publicIP = requests.get('https://api.ipify.org').content.decode('utf8')
+    def __init__(self, port:int, bootstrapNodes:list, snapshotPath=None, snapshotInterval=60.0,
+            lookupCacheTTL=60.0, lookupCacheNearbyBits=0, refreshInterval=3600.0, refreshJitter=60.0,
+            maxFrameSize=MAX_FRAME_SIZE, alpha=3, wireCodec='binary', serverWorkers=16, serverBacklog=1024,
+            blocklistPath=None, publicIP=None, addressCachePath=None, addressLookupURL='https://api.ipify.org'):
+        # initialize the network, a configured or cached address is used right away,
+        # peers and addressLookupURL (None = never ask) correct it in the background
+        self.discovery = AddressDiscovery(publicIP, addressCachePath or f"address_{port}.cache")
+        self.publicIP = self.discovery.public_ip
+        self.addressLookupURL = addressLookupURL
         if self.publicIP in bootstrapNodes: bootstrapNodes.remove(self.publicIP)
-        self.localIP = self.get_local_ip()
+        self.localIP = local_interface_ip()
         self.port = port
-        self.pendingResponse = None
+        self.pool = SocketPool()
+        self.channels = {} # ip -> RequestChannel shared by all requests to that node
+        self.channelsLock = Lock()
+        self.alpha = alpha # parallel queries per lookup
+        self.maxFrameSize = maxFrameSize
+        self.codec = BinaryCodec(160, contact_dicts=True) if wireCodec == 'binary' else None # 'json' for debugging
+        # blocklistPath holds ips and CIDR ranges to drop, e.g. WebAppV2/bitchat/ips.txt
+        blocklist = Blocklist(blocklistPath).start_watching() if blocklistPath else None
+        self.server = SelectorServer((self.localIP, self.port), self.handleMessage, self.codec,
+            serverWorkers, serverBacklog, admission=Admission(blocklist=blocklist))
 
-        # initialize the Storage
-        self.DHT = [[] for bucket in range(160)]
-        self.CID = hashlib.sha1(os.urandom(20)).hexdigest()
+        # initialize the Storage, a snapshot of the last run brings back our CID and contacts
+        self.snapshotPath = snapshotPath or f"dht_{port}.snapshot"
+        self.snapshotInterval = snapshotInterval
+        snapshot = load_snapshot(self.snapshotPath)
+        if snapshot and snapshot[1] == 160:
+            self.CID = format(snapshot[0], '040x'); self.snapshotContacts = snapshot[2]
+        else:
+            self.CID = hashlib.sha1(os.urandom(20)).hexdigest(); self.snapshotContacts = []
+        self.nodeID = int(self.CID, base=16)
+        self.DHT = RoutingTable(self.nodeID, 160)
+        self.lookupCache = LookupCache(self.DHT, lookupCacheTTL, lookupCacheNearbyBits)
         self.bootstrapIPs = bootstrapNodes
+        self.refreshInterval = refreshInterval
+        self.refreshJitter = refreshJitter
 
+    def start(self):
         # run server & bootstrapping in parallel
         Thread(target=self.receiveData).start()
         Thread(target=self.bootstrap).start()
+        Thread(target=self.snapshotLoop).start()
+        Thread(target=self.sweepChannels, daemon=True).start()
+        Thread(target=self.discoverPublicIP, daemon=True).start()
 
     def bootstrap(self):
+        self.revalidateContacts(self.snapshotContacts)
         while True:
-            time.sleep(1)
-            bucketTargets = []
-            for i in range(160):
-                targetCID = self.generateTargetCID(i)
-                bucketTargets.append(targetCID)
-            
-            # Fill up the DHT with the bootstrap nodes
-            for node in self.bootstrapIPs:
-                self.sendData(node, {'nodeInfoRequest': (self.publicIP, self.CID)})
-                
-            # Lookup the closest node for each Bucket Range
-            for index, bucket in enumerate(bucketTargets):
-                closestNodes = self.deepNodeSearch(bucket, 5)
-                for node in closestNodes:
-                    print(f"Looking to fill bucket {index}", end="\r")
-                    if self.getBucketIndex(next(iter(dict(node)))) == index: 
-                        print(f"\nFound Node {node} in bucket {index}")
-                        self.addNode(node[next(iter(dict(node)))], next(iter(dict(node))))
-
-
-    def getClosestCIDs(self, cid, amount=16) -> list:
-        all_nodes = []
-        for bucket in self.DHT:
-            for node in bucket:
-                all_nodes.append(node)
-
-        all_nodes.sort(key=lambda node: int(next(iter(dict(node))), base=16) ^ int(cid, base=16))
-        return all_nodes[:amount]
-    
-    def askForClosestNodes(self, cid, targetNodeIP):
-        # Ask the target node for its closest nodes to cid
-        data = {'closestNodesRequest': (self.publicIP, cid)}
-        self.sendData(targetNodeIP, data)
-        while self.pendingResponse == None:
-            time.sleep(1)
-
-        return self.pendingResponse
-
-
-    def deepNodeSearch(self, cid, amount):
-        # Keep track of k closest nodes we've seen
-        closest_nodes = []
-        asked_nodes = []
-        
-        # Start with closest nodes from our buckets
-        closest_nodes = self.getClosestCIDs(cid, amount=20)
-        closest_distance = float('inf')
-        
-        while True:
-            next_to_ask = None
-            for node in closest_nodes:
-                if node not in asked_nodes:
-                    distance = int(int(next(iter(dict(node))), base=16) ^ int(cid, base=16)).bit_length() - 1
-                    if distance < closest_distance:
-                        next_to_ask = node
-                        closest_distance = distance
-            
-            # If we've asked all nodes or no closer nodes found, we're done
-            if not next_to_ask:
-                break
-                
-            # Ask this node for its closest nodes
-            asked_nodes.append(next_to_ask)
-            new_nodes = self.askForClosestNodes(cid, next_to_ask[next(iter(dict(next_to_ask)))])
-            self.pendingResponse = None
-            
-            # Update our list of closest nodes
-            all_nodes = closest_nodes + new_nodes
-            all_nodes.sort(key=lambda node: int(next(iter(dict(node))), base=16) ^ int(cid, base=16))
-            closest_nodes = all_nodes[:amount]
-            
-            # Update closest distance we've seen
-            new_closest = int(next(iter(dict(closest_nodes[0]))), base=16) ^ int(cid, base=16)
-            if new_closest >= closest_distance:
-                break
-            closest_distance = new_closest
-
-        return closest_nodes[:amount]
-
-
-    def get_local_ip(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server.connect(('8.8.8.8', 80)); local_ip = server.getsockname()[0];
-        server.close(); return local_ip
+            if len(self.DHT) == 0: self.join()
+
+            # Lookup only the Bucket Ranges without any lookup during refreshInterval
+            for bucket in self.DHT.stale_buckets(self.refreshInterval):
+                self.refreshBucket(bucket)
+            waitTime = self.DHT.next_refresh(self.refreshInterval) if len(self.DHT) else 5.0
+            time.sleep(waitTime + random.uniform(0, self.refreshJitter))
+
+    def join(self):
+        # Fill up the DHT with the bootstrap nodes
+        for node in self.bootstrapIPs:
+            try:
+                response = self.request(node, {'nodeInfoRequest': (self.publicIP, self.CID)})
+                self.addNode(response['nodeInfoResponse'][0], response['nodeInfoResponse'][1])
+                self.observeAddress(response, node)
+            except RPC_ERRORS: continue
+        # A lookup for our own CID fills the buckets next to us
+        if len(self.DHT): self.deepNodeSearch(self.nodeID, 5, useCache=False)
+
+    def refreshBucket(self, bucket):
+        closestNodes = self.deepNodeSearch(bucket.random_id(), 5, useCache=False)
+        for node in closestNodes:
+            print(f"Looking to fill bucket {bucket}", end="\r")
+            if bucket.covers(node.id) and node.id not in self.DHT: 
+                print(f"\nFound Node {self.toWire(node)} in bucket {bucket}")
+                self.addContact(node)
+
+
+    def getClosestCIDs(self, target: int, amount=16) -> list:
+        return self.DHT.closest(target, amount)
     
-    def getBucketIndex(self, otherCid: str):
-        # Finds in which bucket the other_cid belongs
-        hash_0 = int(self.CID, base=16)
-        hash_1 = int(otherCid, base=16)
-        distance = hash_0 ^ hash_1
-        return distance.bit_length() - 1
+    def askForClosestNodes(self, target: int, node: NodeContact):
+        # Ask the target node for its closest nodes to target, giving up after its RTO
+        data = {'closestNodesRequest': (self.publicIP, format(target, '040x'))}
+        started = time.monotonic()
+        try: response = self.request(node.ip, data, timeout=node.rto())
+        except TimeoutError: node.record_timeout(); raise
+        node.record_rtt(time.monotonic() - started)
+        if not isinstance(response, dict) or not isinstance(response.get('closestNodesResponse'), list):
+            raise ValueError(f"{node.ip} sent a malformed closest nodes reply")
+        return [self.fromWire(node) for node in response['closestNodesResponse']]
+
+
+    def deepNodeSearch(self, target: int, amount, useCache=True):
+        # Keeps alpha queries in flight, each answer may bring closer nodes to ask.
+        # A query running past its node's p95 stops counting, so the next node gets
+        # asked in parallel while the slow one may still answer. Stragglers are
+        # left to finish on their own once the lookup is done
+        cached = self.lookupCache.get(target, amount) if useCache else None
+        if cached is not None: return cached
+        self.DHT.touch(target)
+        shortlist = Shortlist(target, amount, self.getClosestCIDs(target, amount=20), self.nodeID)
+        pending = {} # future -> (node, hedge deadline or None once hedged)
+        executor = ThreadPoolExecutor(max_workers=4 * self.alpha) # room for hedged stragglers
+        try:
+            while not shortlist.finished():
+                inFlight = sum(1 for _, deadline in pending.values() if deadline is not None)
+                for nextToAsk in shortlist.next_to_query(self.alpha - inFlight):
+                    node = self.DHT.get(nextToAsk.id) or nextToAsk
+                    shortlist.mark_pending(node)
+                    pending[executor.submit(self.askForClosestNodes, target, node)] = (node, time.monotonic() + node.hedge_delay())
+                if not pending: break
+                deadlines = [deadline for _, deadline in pending.values() if deadline is not None]
+                waitTime = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+                done, _ = wait(pending, timeout=waitTime, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, _ = pending.pop(future)
+                    try: newNodes = future.result()
+                    except RPC_ERRORS: shortlist.mark_failed(node); continue
+                    shortlist.mark_answered(node, newNodes)
+                    self.addContact(node)
+                now = time.monotonic()
+                for future, (node, deadline) in pending.items():
+                    if deadline is not None and deadline <= now: pending[future] = (node, None)
+        finally: executor.shutdown(wait=False, cancel_futures=True)
+
+        self.lookupCache.put(target, amount, shortlist.result())
+        return shortlist.result()
+
+    def discoverPublicIP(self):
+        if self.addressLookupURL and self.discovery.query_service(self.addressLookupURL):
+            self.setPublicIP(self.discovery.public_ip)
+
+    def setPublicIP(self, ip: str):
+        if ip != self.publicIP: print(f"Public address is now {ip}")
+        self.publicIP = ip
+
+    def observeAddress(self, response: dict, reporter: str):
+        # nodeInfoResponse carries the address the peer saw us at
+        info = response.get('nodeInfoResponse', ())
+        if len(info) > 2 and self.discovery.observe(info[2], reporter):
+            self.setPublicIP(self.discovery.public_ip)
+
+    def toWire(self, contact: NodeContact) -> dict:
+        return {contact.cid(160): contact.ip}
+
+    def fromWire(self, node: dict) -> NodeContact:
+        # A peer may send anything, a contact that is not {cid: ip} is rejected
+        if not isinstance(node, dict) or len(node) != 1: raise ValueError(f"malformed contact {node!r}")
+        cid, ip = next(iter(node.items()))
+        if not isinstance(cid, str) or not isinstance(ip, str): raise ValueError(f"malformed contact {node!r}")
+        return NodeContact.from_cid(cid, ip)
 
     def addNode(self, ip: str, cid: str):
-        # Adds the node to the DHT
-        dht_index = self.getBucketIndex(cid)
-        self.DHT[dht_index].append({cid:ip})
+        # Adds the node to the DHT, a full bucket first pings its oldest node
+        self.addContact(self.fromWire({cid: ip}))
+
+    def addContact(self, contact: NodeContact):
+        staleNode = self.DHT.add_contact(contact)
+        if staleNode: Thread(target=self.pingBeforeEvict, args=(staleNode,)).start()
+
+    def ping(self, contact: NodeContact) -> bool:
+        try:
+            response = self.request(contact.ip, {'nodeInfoRequest': (self.publicIP, self.CID)}, timeout=contact.rto())
+            self.observeAddress(response, contact.ip)
+            contact.last_seen = time.time()
+            return True
+        except RPC_ERRORS: return False
+
+    def pingBeforeEvict(self, staleNode: NodeContact):
+        # The oldest node keeps its slot as long as it is still reachable
+        self.DHT.resolve_ping(staleNode.id, self.ping(staleNode))
+
+    def revalidateContacts(self, contacts: list, patience=1.0):
+        # Contacts of the last run only return to the DHT once they are reachable
+        # again, each as soon as its ping answers. Returns with the first answer,
+        # or after patience seconds without one so the bootstrap IPs get asked,
+        # the other pings go on in the background instead of holding up the join
+        executor = ThreadPoolExecutor(max_workers=32)
+        pings = [executor.submit(self.revalidateContact, contact) for contact in contacts]
+        executor.shutdown(wait=False)
+        try:
+            for answered in as_completed(pings, timeout=patience):
+                if answered.result(): return
+        except FutureTimeout: pass
+
+    def revalidateContact(self, contact: NodeContact) -> bool:
+        if not self.ping(contact): return False
+        self.addContact(contact)
+        return True
+
+    def snapshotLoop(self):
+        while True:
+            time.sleep(self.snapshotInterval)
+            if len(self.DHT): self.DHT.save_snapshot(self.snapshotPath)
 
     def receiveData(self):
         # Start the server
-        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listener.bind((self.localIP, self.port)); listener.listen(5)
         print(f"Started FileSytem Node on IP: {self.publicIP}, PORT: {self.port}, CID: {self.CID}")
+        self.server.serve_forever()
+
+    def handleMessage(self, data:dict, peerIP=None):
+        if 'hello' in data:
+            return {'hello': choose_codec(data['hello']) if self.codec else 'json'}
+
+        elif 'nodeInfoRequest' in data:
+            # Stored under the address we see it at, the one it claims may be the LAN
+            # address it started with before discovery found the public one
+            self.addNode(peerIP or data['nodeInfoRequest'][0], data['nodeInfoRequest'][1])
+            return {'nodeInfoResponse': (self.publicIP, self.CID, peerIP)}
+
+        elif 'closestNodesRequest' in data:
+            closestNodes = self.getClosestCIDs(int(data['closestNodesRequest'][1], base=16), 20)
+            return {'closestNodesResponse': [self.toWire(node) for node in closestNodes]}
 
+    def request(self, ip:str, data:dict, timeout=5.0) -> dict:
+        # All requests to a node share one channel, a channel the peer closed
+        # while idle is replaced once
+        for attempt in range(2):
+            channel = self.getChannel(ip, timeout)
+            try: return channel.request(data, timeout)
+            except ConnectionError:
+                if attempt: raise
+
+    def getChannel(self, ip:str, timeout=5.0) -> RequestChannel:
+        with self.channelsLock:
+            channel = self.channels.get(ip)
+            if channel and not channel.closed: return channel
+            self.closeIdleChannels()
+        client = self.pool.acquire(ip, self.port, timeout)
+        channel = RequestChannel(client, self.pool.discard, self.maxFrameSize, self.codec)
+        if self.codec:
+            # The hello settles the encoding for everything after it
+            try: channel.binary = channel.request({'hello': CODECS}, timeout).get('hello') == 'binary'
+            except RPC_ERRORS: channel.close(); raise
+        with self.channelsLock:
+            current = self.channels.get(ip)
+            if current and not current.closed: channel.close(); return current
+            self.channels[ip] = channel
+        return channel
+
+    def closeIdleChannels(self):
+        # Each channel holds its pooled socket for good, so channels unused for
+        # the pool's idle timeout are closed and a full pool gives up its least
+        # recently used idle channel for the next peer. Caller holds channelsLock
+        for ip in [ip for ip, channel in self.channels.items() if channel.closed]: del self.channels[ip]
+        now = time.monotonic()
+        for lastUsed, ip in sorted((channel.last_used, ip) for ip, channel in self.channels.items() if channel.idle()):
+            if now - lastUsed < self.pool.idle_timeout and not self.pool.full(): break
+            self.channels.pop(ip).close()
+
+    def sweepChannels(self):
         while True:
-            clientSocket, clientAddress = listener.accept()
-            data = json.loads(clientSocket.recv(1024).decode("utf-8"))
-            # Handle the incoming data
-
-            if 'nodeInfoRequest' in data:
-                self.addNode(data['nodeInfoRequest'][0], data['nodeInfoRequest'][1])
-                self.sendData(data['nodeInfoRequest'][0], {'nodeInfoResponse': (self.publicIP, self.CID)})
-
-            elif 'nodeInfoResponse' in data:
-                self.addNode(data['nodeInfoResponse'][0], data['nodeInfoResponse'][1])
-
-            elif 'closestNodesRequest' in data:
-                self.sendData(data['closestNodesRequest'][0], 
-                    {'closestNodesResponse': self.getClosestCIDs(data['closestNodesRequest'][1], 20)})
-                
-            elif 'closestNodesResponse' in data:
-                self.pendingResponse = data['closestNodesResponse']
-
-
-    def sendData(self, ip:str, data:dict):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((ip, self.port))
-        data = json.dumps(data, indent = 4)
-        client.send(data.encode("utf-8"))
-        client.close()
-
-    def generateTargetCID(self, bucketDistance: int) -> str:
-        myCidInt = int(self.CID, 16)
-        lowerBound = 2 ** bucketDistance
-        upperBound = 2 ** (bucketDistance + 1) - 1
-        distance = random.randint(lowerBound, upperBound)
-        targetInt = myCidInt ^ distance
-        return format(targetInt, '040x')
-    
+            time.sleep(self.pool.idle_timeout / 2)
+            with self.channelsLock: self.closeIdleChannels()
+
     def showDHT(self):
-        for i, bucket in enumerate(self.DHT):
+        for bucket in self.DHT.buckets:
             if len(bucket) == 0: continue
-            print(f"Bucket {i}: ", end="")
-            for node in bucket:
-                print(f"{node} ", end="")
+            print(f"Bucket {bucket}: ", end="")
+            for node in bucket.contacts.values():
+                print(f"{self.toWire(node)} ", end="")
             print()
 
-    
-myNode = Node(port=60000, bootstrapNodes=['79.230.223.138']);
-while True: 
-    time.sleep(5); # myNode.showDHT()
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a V1 DHT node")
+    parser.add_argument('--port', type=int, default=60000)
+    parser.add_argument('--bootstrap', action='append', metavar='IP', help="seed node, repeatable (default: 79.230.223.138)")
+    parser.add_argument('--public-ip', help="address peers reach us at (default: discovered)")
+    parser.add_argument('--no-lookup', action='store_true', help="never ask an http service for the public address")
+    parser.add_argument('--blocklist', help="file of ips and CIDR ranges to drop, e.g. WebAppV2/bitchat/ips.txt")
+    parser.add_argument('--codec', choices=CODECS, default='binary')
+    parser.add_argument('--show-dht', action='store_true', help="print the buckets every 5 seconds")
+    args = parser.parse_args()
+
+    myNode = Node(port=args.port, bootstrapNodes=args.bootstrap or ['79.230.223.138'], wireCodec=args.codec,
+        blocklistPath=args.blocklist, publicIP=args.public_ip,
+        addressLookupURL=None if args.no_lookup else 'https://api.ipify.org')
+    myNode.start()
+    while True:
+        time.sleep(5)
+        if args.show_dht: myNode.showDHT()
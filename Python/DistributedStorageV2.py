@@ -1,142 +1,672 @@
+import argparse
 import asyncio
-import requests
-import json
-import socket
 import binascii
+import json
 import os
+import time
 import random
+import weakref
+from RoutingTable import RoutingTable, NodeContact, load_snapshot
+from NodeLookup import Shortlist, LookupCache
+from ConnectionPool import ConnectionPool
+from Protocol import encode_message, decode_message, read_frame, read_message, choose_codec, CODECS, FRAME_BINARY, MAX_FRAME_SIZE
+from BinaryCodec import BinaryCodec
+from DatagramRPC import DatagramRPC, DatagramTooLarge, MAX_DATAGRAM_SIZE
+from Admission import Admission
+from Blocklist import Blocklist
+from ValueStore import ValueStore, CorruptRecord
+from ObjectManifest import content_key, build_manifest, parse_manifest, CHUNK_SIZE
+from AddressDiscovery import AddressDiscovery, local_interface_ip, valid_ip, valid_port
+try: from ContactIndex import ContactIndex
+except ImportError: ContactIndex = None
+
+RPC_ERRORS = (OSError, asyncio.TimeoutError, ValueError, KeyError, TypeError, IndexError, AttributeError)
+MAX_BATCH_KEYS = 64
+MAX_BATCH_VALUES = 8 # keys per find_value_batch_request, their values share one reply
+# Requests whose replies never fit into a datagram go straight to TCP
+STREAM_ONLY = {'closest_nodes_batch_request', 'find_value_batch_request'}
+STREAM_FALLBACK_TTL = 300.0 # a peer that did not answer a datagram is asked over TCP for this long
+SERVER_IDLE_TIMEOUT = 120.0
+REQUEST_TIMEOUT = 10.0 # a request that started has to arrive completely within this
+COMPACTION_INTERVAL = 60.0
+MAX_PARALLEL_CHUNKS = 8 # chunk stores in flight per object
+CHUNK_LOOKUP_WINDOW = 32 # chunk keys of an object looked up together
+MAX_VALUE_SIZE = 8 * 1024 * 1024 # bytes of value_size
+MAX_REQUEST_SIZE = MAX_VALUE_SIZE + 64 * 1024 # largest frame a peer may send us, a STORE of the largest value
+MAX_STORED_BYTES = 1024 * 1024 * 1024 # values a node keeps for the network
+MIN_TRANSFER_RATE = 1024 * 1024 # bytes per second a request carrying a value is given on top of the RTO
+
+def key_id(key: str) -> int:
+    # Values live on the nodes whose 16 bit ids are closest to the top of their key
+    return int(key[:4], base=16)
+
+def value_size(value: str) -> int:
+    # Bytes a value takes in a message, as a JSON string, which is never
+    # shorter than its UTF-8 in a binary one
+    return len(json.dumps(value))
+
+def parse_address(address, default_port: int) -> tuple:
+    # Seeds are given as 'ip', 'ipv4:port' or (ip, port)
+    if isinstance(address, (tuple, list)): return address[0], int(address[1])
+    if address.count(':') == 1:
+        ip, port = address.split(':'); return ip, int(port)
+    return address, default_port
 
 class file_system_node:
-    def __init__(self, port:int, bootstrap_nodes:list):
+    def __init__(self, port:int, bootstrap_nodes:list, contact_index=False, snapshot_path=None, snapshot_interval=60.0, alpha=3,
+            lookup_cache_ttl=60.0, lookup_cache_nearby_bits=0, refresh_interval=3600.0, refresh_jitter=60.0,
+            connection_pool=None, max_frame_size=MAX_FRAME_SIZE, wire_codec='binary', use_udp=True,
+            max_datagram_size=MAX_DATAGRAM_SIZE, admission=None, blocklist_path=None, public_ip=None,
+            address_cache_path=None, address_lookup_url='https://api.ipify.org', address_discovery=None,
+            storage_path=None, max_stored_bytes=MAX_STORED_BYTES):
+        # Nothing runs until start_node, so many nodes can share one event loop
         self.port = port
-        self.local_ip = self.get_local_ip()
-        self.public_ip = requests.get('https://api.ipify.org').content.decode('utf8')
-        self.DHT = [[] for _ in range(16)]
-        self.CID = binascii.hexlify(os.urandom(2)).decode('utf-8') # Random 16 bit hash
-        asyncio.run(self.start_node(bootstrap_nodes))
-
-    async def start_node(self, bootstrap_nodes:list):
-        server_task = asyncio.create_task(self.run_server())
-        bootstrap_task = asyncio.create_task(self.bootstrap(bootstrap_nodes))
-        await asyncio.gather(server_task, bootstrap_task)
-
-    def get_local_ip(self) -> str:
-        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server.connect(('8.8.8.8', 80)); local_ip = server.getsockname()[0];
-        server.close(); return local_ip
-            
-    async def run_server(self):
+        self.bootstrap_nodes = bootstrap_nodes
+        self.alpha = alpha # parallel queries per lookup
+        self.max_frame_size = max_frame_size
+        # 'json' keeps every message readable for debugging
+        self.codec = BinaryCodec(16) if wire_codec == 'binary' else None
+        self.peer_codecs = weakref.WeakKeyDictionary() # pooled writer -> codec agreed on in its hello
+        self.use_udp = use_udp
+        self.max_datagram_size = max_datagram_size
+        self.datagrams = None # DatagramRPC once run_server bound the port
+        self.stream_peers = {} # (ip, port) -> until when requests skip UDP
+        # blocklist_path holds ips and CIDR ranges to drop, e.g. WebAppV2/bitchat/ips.txt
+        blocklist = Blocklist(blocklist_path).start_watching() if blocklist_path else None
+        self.admission = admission or Admission(blocklist=blocklist)
+        self.refresh_interval = refresh_interval
+        self.refresh_jitter = refresh_jitter
+        self.local_ip = local_interface_ip()
+        # Startup never waits for the network: a configured or cached address is used right
+        # away, peers and address_lookup_url (None = never ask) correct it in the background
+        self.discovery = address_discovery or AddressDiscovery(public_ip, address_cache_path or f"address_{port}.cache")
+        self.address_lookup_url = address_lookup_url
+        # A snapshot of the last run brings back our id and the contacts to revalidate
+        self.snapshot_path = snapshot_path or f"dht_{port}.snapshot"
+        self.snapshot_interval = snapshot_interval
+        snapshot = load_snapshot(self.snapshot_path)
+        if snapshot and snapshot[1] == 16:
+            self.CID = format(snapshot[0], '04x'); self.snapshot_contacts = snapshot[2]
+        else:
+            self.CID = binascii.hexlify(os.urandom(2)).decode('utf-8') # Random 16 bit hash
+            self.snapshot_contacts = []
+        self.node_id = int(self.CID, base=16)
+        self.DHT = RoutingTable(self.node_id, 16)
+        self.lookup_cache = LookupCache(self.DHT, lookup_cache_ttl, lookup_cache_nearby_bits)
+        # Crawler and bootstrap nodes can answer closest queries from every contact ever seen
+        if contact_index and ContactIndex is None: raise ImportError("contact_index requires numpy")
+        self.contact_index = ContactIndex(16) if contact_index else None
+        # Values this node stores for the network, kept on disk in storage_path
+        self.values = ValueStore(storage_path or f"values_{port}")
+        self.max_stored_bytes = max_stored_bytes # a STORE that would take the values past this is refused
+        self.background_tasks = set()
+        self.pool = connection_pool or ConnectionPool()
+        self.server = None
+
+    def run(self):
+        asyncio.run(self.start_node())
+
+    async def start_node(self):
+        await self.listen()
+        bootstrap_task = asyncio.create_task(self.bootstrap())
+        snapshot_task = asyncio.create_task(self.snapshot_loop())
+        sweep_task = asyncio.create_task(self.pool.sweep_forever())
+        discovery_task = asyncio.create_task(self.discover_public_ip())
+        compaction_task = asyncio.create_task(self.compaction_loop())
+        async with self.server:
+            await asyncio.gather(self.server.serve_forever(), bootstrap_task, snapshot_task, sweep_task, discovery_task,
+                compaction_task)
+
+    @property
+    def public_ip(self) -> str:
+        return self.discovery.public_ip
+
+    async def discover_public_ip(self):
+        if not self.address_lookup_url: return
+        known_ip = self.public_ip
+        await asyncio.to_thread(self.discovery.query_service, self.address_lookup_url)
+        if self.public_ip != known_ip: print(f"Public address is now {self.public_ip}")
+
+    def observe_address(self, response, reporter: str):
+        # node_info_response carries the address the peer saw us at
+        if len(response) > 2 and self.discovery.observe(response[2], reporter):
+            print(f"Public address is now {self.public_ip}")
+
+    async def listen(self):
+        # Binds the TCP server and, sharing its port number, the UDP endpoint for small RPCs
         print(f"Server started at {self.public_ip}:{self.port}")
-        server = await asyncio.start_server(self.handle_connection, self.local_ip, self.port)
-        async with server:
-            await server.serve_forever()
+        self.server = await asyncio.start_server(self.handle_connection, self.local_ip, self.port)
+        if self.use_udp:
+            _, self.datagrams = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DatagramRPC(self.handle_message, self.codec, self.max_datagram_size, admission=self.admission,
+                    stream_only=STREAM_ONLY, reply_size=self.reply_size),
+                local_addr=(self.local_ip, self.port))
 
     async def handle_connection(self, reader, writer):
-        data_raw = await reader.read(1024)
-        data = json.loads(data_raw.decode("utf-8"))
-
-        if 'node_info_request' in data:
-            self.add_node(data['node_info_request'][0], data['node_info_request'][1])
-            response = {'node_info_response': (self.public_ip, self.CID)}
-            writer.write(json.dumps(response).encode())
-            await writer.drain()
-        elif 'closest_nodes_request' in data:
-            closest_nodes = self.get_closest_nodes(data['closest_nodes_request'][1])
-            response = {'closest_nodes_response': closest_nodes}
-            writer.write(json.dumps(response).encode())
-            await writer.drain()
-
-    async def send_data(self, ip: str, data: dict, timeout=5.0):
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(ip, self.port), timeout=timeout)
-        writer.write(json.dumps(data).encode())
-        await writer.drain()
-        
-        if 'node_info_request' in data:
-            response_data = await asyncio.wait_for(reader.read(1024), timeout)
-            response = json.loads(response_data.decode())['node_info_response']
-            writer.close(); await writer.wait_closed()
-            return response
+        # Peers keep their connection open, every request is answered in order
+        # and in the encoding it came in. Peers over their limits are cut off at
+        # the frame header, before its payload is read
+        ip = writer.get_extra_info('peername')[0]
+        if not self.admission.open_connection(ip): writer.close(); return
+        try:
+            while True:
+                try:
+                    kind, payload = await read_frame(reader, MAX_REQUEST_SIZE, REQUEST_TIMEOUT, SERVER_IDLE_TIMEOUT,
+                        lambda: self.admission.allow(ip))
+                    response = self.handle_message(decode_message(kind, payload, self.codec), ip)
+                except (ConnectionError, asyncio.TimeoutError, ValueError, KeyError, TypeError, IndexError, AttributeError): break
+                if response is None: continue
+                writer.write(encode_message(response, self.codec if kind == FRAME_BINARY else None))
+                # A client that gave up on a large reply, like a cancelled chunk fetch, resets the connection
+                try: await writer.drain()
+                except ConnectionError: break
+        finally: writer.close(); self.admission.close_connection(ip)
+
+    def handle_message(self, data: dict, peer_ip=None):
+        if 'hello' in data:
+            return {'hello': choose_codec(data['hello']) if self.codec else 'json'}
+        elif 'node_info_request' in data:
+            # Stored under the address we see it at, the one it claims may be the LAN
+            # address it started with before discovery found the public one
+            claimed_ip, cid, *port = data['node_info_request'][:3]
+            self.add_node(peer_ip or claimed_ip, cid, *port)
+            return {'node_info_response': (self.public_ip, self.CID, peer_ip)}
         elif 'closest_nodes_request' in data:
-            response_data = await asyncio.wait_for(reader.read(1024), timeout)
-            response = json.loads(response_data.decode())['closest_nodes_response']
-            writer.close(); await writer.wait_closed()
-            return response
-        else: writer.close(); await writer.wait_closed(); return None
+            # Frames carry any size, answer with a full bucket worth of contacts
+            closest_nodes = self.get_closest_nodes(int(data['closest_nodes_request'][1], base=16), self.DHT.k)
+            return {'closest_nodes_response': [self.to_wire(node) for node in closest_nodes]}
+        elif 'closest_nodes_batch_request' in data:
+            return {'closest_nodes_batch_response': {cid: [self.to_wire(node)
+                for node in self.get_closest_nodes(int(cid, base=16), self.DHT.k)]
+                for cid in data['closest_nodes_batch_request'][1][:MAX_BATCH_KEYS]}}
+        elif 'store_request' in data:
+            return {'store_response': self.store_value(data['store_request'][2], data['store_request'][3])}
+        elif 'find_value_request' in data:
+            key = data['find_value_request'][2]
+            value = self.stored_value(key)
+            if value is not None: return {'find_value_response': {'value': value}}
+            closest_nodes = self.get_closest_nodes(key_id(key), self.DHT.k)
+            return {'find_value_response': {'nodes': [self.to_wire(node) for node in closest_nodes]}}
+        elif 'find_value_batch_request' in data:
+            # Values go along until the reply carries MAX_VALUE_SIZE of them, a
+            # key held beyond that is only marked held and fetched on its own
+            answers = {}; budget = MAX_VALUE_SIZE
+            for key in data['find_value_batch_request'][2][:MAX_BATCH_VALUES]:
+                value = self.stored_value(key)
+                size = value_size(value) if value is not None else 0
+                if value is not None and size <= budget: answers[key] = {'value': value}; budget -= size
+                elif value is not None: answers[key] = {'held': True}
+                else: answers[key] = {'nodes': [self.to_wire(node) for node in self.get_closest_nodes(key_id(key), self.DHT.k)]}
+            return {'find_value_batch_response': answers}
+
+    def reply_size(self, data: dict) -> int:
+        # What a reply takes at least, known without reading a stored value
+        if 'find_value_request' in data: return self.values.size(data['find_value_request'][2]) or 0
+        return 0
+
+    async def send_data(self, ip: str, data: dict, timeout=5.0, port=None):
+        return (await self.exchange(ip, data, timeout, port))[0]
+
+    async def exchange(self, ip: str, data: dict, timeout=5.0, port=None) -> tuple:
+        # Returns (response, round trip time or None) within timeout. Requests go
+        # out as a single datagram when they fit and over TCP when the request or
+        # its reply is too large. A datagram unanswered after half the timeout has
+        # the request sent over TCP as well, where the hello settles the codec, so
+        # a JSON only node dropping our binary datagram or a firewalled port is
+        # still reached. Whichever answers first wins, a peer only TCP reached
+        # keeps getting TCP for STREAM_FALLBACK_TTL.
+        # Peers without a port of their own listen on ours
+        port = port or self.port
+        request_type = next(iter(data))
+        if not self.datagrams or not request_type.endswith('_request') or request_type in STREAM_ONLY \
+                or self.stream_peers.get((ip, port), 0) >= time.monotonic():
+            return await self.timed_stream(ip, data, timeout, port)
+        deadline = time.monotonic() + timeout
+        datagram = asyncio.create_task(self.datagrams.request((ip, port), data, timeout, retries=0))
+        try:
+            response, rtt = await asyncio.wait_for(asyncio.shield(datagram), timeout / 2)
+            return response[request_type.replace('_request', '_response')], rtt
+        except DatagramTooLarge: return await self.timed_stream(ip, data, deadline - time.monotonic(), port)
+        except (asyncio.TimeoutError, ConnectionError): pass
+        stream = asyncio.create_task(self.timed_stream(ip, data, deadline - time.monotonic(), port))
+        pending = {stream} if datagram.done() else {stream, datagram}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done: raise asyncio.TimeoutError("no answer over UDP or TCP")
+                if datagram in done and datagram.exception() is None:
+                    response, rtt = datagram.result()
+                    return response[request_type.replace('_request', '_response')], rtt
+                if stream in done and stream.exception() is None:
+                    if len(self.stream_peers) > 4096:
+                        self.stream_peers = {peer: until for peer, until in self.stream_peers.items() if until > time.monotonic()}
+                    self.stream_peers[(ip, port)] = time.monotonic() + STREAM_FALLBACK_TTL
+                    return stream.result()
+            return stream.result() # raises why TCP failed
+        finally:
+            for task in (datagram, stream):
+                if not task.done(): task.cancel()
+                elif not task.cancelled(): task.exception() # the loser's error is not worth a warning
+
+    async def timed_stream(self, ip: str, data: dict, timeout: float, port=None) -> tuple:
+        started = time.monotonic()
+        response = await asyncio.wait_for(self.send_stream(ip, data, timeout, port), timeout)
+        return response, time.monotonic() - started
+
+    async def send_stream(self, ip: str, data: dict, timeout=5.0, port=None):
+        # Reuses a pooled connection, a peer may have closed it while it was idle
+        # so that one failure is retried once on a fresh connection
+        request_type = next(iter(data))
+        port = port or self.port
+        while True:
+            reader, writer, reused = await self.pool.acquire(ip, port, timeout)
+            reusable = False
+            # A fresh connection starts with a hello naming our codecs, it is sent
+            # right ahead of the first request which still goes out as JSON
+            hello = not reused and self.codec is not None
+            try:
+                if hello: writer.write(encode_message({'hello': CODECS}))
+                writer.write(encode_message(data, self.peer_codecs.get(writer)))
+                await writer.drain()
+                if hello and (await read_message(reader, self.max_frame_size, timeout)).get('hello') == 'binary':
+                    self.peer_codecs[writer] = self.codec
+                # Every *_request is answered with the matching *_response
+                if not request_type.endswith('_request'): reusable = True; return None
+                response = await read_message(reader, self.max_frame_size, timeout, self.codec)
+                reusable = True
+                return response[request_type.replace('_request', '_response')]
+            except ConnectionError:
+                if not reused: raise
+            finally: self.pool.release(ip, port, reader, writer, reusable)
         
-    async def bootstrap(self, bootstrap_nodes):
+    async def bootstrap(self):
         print(f"Bootstrapping started with CID: {self.CID}")
-        bootstrap_nodes.remove(self.public_ip) if self.public_ip in bootstrap_nodes else None
-        bucket_targets = []
-        for i in range(16): bucket_targets.append(self.generate_target_cid(i))
-        for node in bootstrap_nodes:
-            new_node = await self.send_data(node, {'node_info_request': (self.public_ip, self.CID)})
-            self.add_node(new_node[0], new_node[1])
-
-        while True: 
-            for index, bucket in enumerate(bucket_targets):
-                closest_nodes = await self.deep_node_search(bucket)
-                for node in closest_nodes:
-                    if self.get_bucket_index(node[0]) == index: 
-                        self.add_node(node[1], node[0])
-            await asyncio.sleep(1) # let other code execute
-
-    async def deep_node_search(self, cid: str, amount=4) -> list:
-        closest_nodes = []; asked_nodes = []
-        closest_nodes = self.get_closest_nodes(cid)
-        closest_distance = float('inf')
-
+        await self.revalidate_contacts(self.snapshot_contacts)
         while True:
-            next_to_ask = None
+            wait_time = await self.maintain()
+            await asyncio.sleep(wait_time + random.uniform(0, self.refresh_jitter))
+
+    async def maintain(self) -> float:
+        # One round of upkeep, returns the seconds until the next one is due. Only
+        # buckets without a lookup during refresh_interval get refreshed, so an
+        # idle node sends next to nothing once it has joined
+        if len(self.DHT) == 0: await self.join(self.bootstrap_nodes)
+        await self.refresh_buckets(self.DHT.stale_buckets(self.refresh_interval))
+        return self.DHT.next_refresh(self.refresh_interval) if len(self.DHT) else 5.0
+
+    async def join(self, bootstrap_nodes: list):
+        # The seeds are only needed when no contact of the last run answered,
+        # a lookup for our own id then fills the buckets next to us
+        own_addresses = {(self.public_ip, self.port), (self.local_ip, self.port)}
+        for ip, port in {parse_address(node, self.port) for node in bootstrap_nodes} - own_addresses:
+            try:
+                new_node = await self.send_data(ip, {'node_info_request': (self.public_ip, self.CID, self.port)}, port=port)
+                self.add_node(new_node[0], new_node[1], port)
+            except RPC_ERRORS: continue
+            self.observe_address(new_node, ip)
+        if len(self.DHT): await self.deep_node_search(self.node_id, use_cache=False)
+
+    async def refresh_buckets(self, buckets: list):
+        targets = {bucket.random_id(): bucket for bucket in buckets}
+        results = await self.deep_node_search_many(list(targets), use_cache=False)
+        for target, closest_nodes in results.items():
             for node in closest_nodes:
-                if node not in asked_nodes:
-                    distance = int(int(node[0], base=16) ^ int(cid, base=16)).bit_length() - 1
-                    if distance < closest_distance:
-                        next_to_ask = node
-                        closest_distance = distance
-            
-            if not next_to_ask: break
-            asked_nodes.append(next_to_ask)
-            new_nodes = await self.ask_for_closest_nodes(next_to_ask[1], cid)
-            all_nodes = closest_nodes + new_nodes
-            all_nodes.sort(key=lambda node: int(node[0], base=16) ^ int(cid, base=16))
-            closest_nodes = all_nodes[:amount]
-            new_closest = int(closest_nodes[0][0], base=16) ^ int(cid, base=16)
-            if new_closest >= closest_distance: break
-            closest_distance = new_closest
-        return closest_nodes[:amount]
-
-    async def ask_for_closest_nodes(self, target_node_ip, cid: str) -> list:
-        return await self.send_data(target_node_ip, {'closest_nodes_request': (self.public_ip, cid)})
-
-    def get_closest_nodes(self, cid, amount=4) -> list:
-        all_nodes = []
-        for bucket in self.DHT:
-            for node in bucket:
-                all_nodes.append(node)
-
-        all_nodes.sort(key=lambda node: int(node[0], base=16) ^ int(cid, base=16))
-        return all_nodes[:amount]
-
-    def get_bucket_index(self, cid: str) -> int:
-        hash_0 = int(self.CID, base=16)
-        hash_1 = int(cid, base=16)
-        distance = hash_0 ^ hash_1
-        return distance.bit_length() - 1
-
-    def add_node(self, ip: str, cid: str):
-        dht_index = self.get_bucket_index(cid)
-        if (cid, ip) in self.DHT[dht_index]: return
-        print(f"Found Node {ip} in bucket {dht_index}")
-        self.DHT[dht_index].append((cid,ip))
-    
-    def generate_target_cid(self, bucketDistance: int) -> str:
-        myCidInt = int(self.CID, base=16)
-        lowerBound = 2 ** bucketDistance
-        upperBound = 2 ** (bucketDistance + 1) - 1
-        distance = random.randint(lowerBound, upperBound)
-        targetInt = myCidInt ^ distance
-        return format(targetInt, '04x')
-
-
-FSN = file_system_node(port=60000, bootstrap_nodes=['79.230.223.138'])
\ No newline at end of file
+                if targets[target].covers(node.id): 
+                    self.add_contact(node)
+
+    async def deep_node_search(self, target: int, amount=4, use_cache=True) -> list:
+        cached = self.lookup_cache.get(target, amount) if use_cache else None
+        if cached is not None: return cached
+        self.DHT.touch(target)
+        closest_nodes, _ = await self.iterative_lookup(target, amount)
+        self.lookup_cache.put(target, amount, closest_nodes)
+        return closest_nodes
+
+    async def iterative_lookup(self, target: int, amount: int, key=None) -> tuple:
+        # Keeps alpha queries in flight until the amount closest nodes have all answered.
+        # A query running past its peer's p95 stops counting, so the next contact gets
+        # asked in parallel while the slow one may still answer. With a key every
+        # query is a FIND_VALUE and the lookup ends at the first node holding it.
+        # Returns (closest nodes that answered, (value, holder) or None)
+        shortlist = Shortlist(target, amount, self.get_closest_nodes(target, amount), self.node_id)
+        pending = {} # task -> (node, hedge deadline or None once hedged)
+        while not shortlist.finished():
+            in_flight = sum(1 for _, deadline in pending.values() if deadline is not None)
+            for node in shortlist.next_to_query(self.alpha - in_flight):
+                node = self.DHT.get(node.id) or node
+                shortlist.mark_pending(node)
+                task = asyncio.create_task(self.ask_for_value(node, key) if key else self.ask_for_closest_nodes(node, target))
+                pending[task] = (node, time.monotonic() + node.hedge_delay())
+            if not pending: break
+            deadlines = [deadline for _, deadline in pending.values() if deadline is not None]
+            wait_time = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            done, _ = await asyncio.wait(pending, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node, _ = pending.pop(task)
+                try: new_nodes, value = task.result() if key else (task.result(), None)
+                except RPC_ERRORS: shortlist.mark_failed(node); continue
+                self.add_contact(node)
+                if value is not None:
+                    for task in pending: task.cancel()
+                    return shortlist.result(), (value, node)
+                shortlist.mark_answered(node, new_nodes)
+            now = time.monotonic()
+            for task, (node, deadline) in pending.items():
+                if deadline is not None and deadline <= now: pending[task] = (node, None)
+        for task in pending: task.cancel()
+        return shortlist.result(), None
+
+    async def deep_node_search_many(self, targets: list, amount=4, use_cache=True) -> dict:
+        # One shortlist per target, each contact is asked once for all the targets
+        # it is a next hop of
+        results = {}; shortlists = {}
+        for target in targets:
+            cached = self.lookup_cache.get(target, amount) if use_cache else None
+            if cached is not None: results[target] = cached; continue
+            self.DHT.touch(target)
+            shortlists[target] = Shortlist(target, amount, self.get_closest_nodes(target, amount), self.node_id)
+
+        await self.batched_lookup(shortlists, self.ask_for_closest_nodes_batch, MAX_BATCH_KEYS)
+        for target, shortlist in shortlists.items():
+            results[target] = shortlist.result()
+            self.lookup_cache.put(target, amount, results[target])
+        return results
+
+    async def ask_for_closest_nodes_batch(self, node: NodeContact, targets: list) -> dict:
+        cids = [format(target, '04x') for target in targets]
+        response = await self.request(node, {'closest_nodes_batch_request': (self.public_ip, cids)})
+        if not isinstance(response, dict): raise ValueError(f"{node.ip} sent a malformed batch reply")
+        return {int(cid, base=16): ([self.from_wire(node) for node in nodes], None) for cid, nodes in response.items()}
+
+    async def batched_lookup(self, shortlists: dict, ask, max_batch: int) -> dict:
+        # Drives one shortlist per key like iterative_lookup, with alpha queries in
+        # flight per key, but a contact that is the next hop of several keys gets
+        # one ask(contact, keys) -> {key: (closer contacts, value or None)} for up
+        # to max_batch of them. Replies are handled as they arrive and a batch past
+        # its contact's p95 stops counting against alpha, so one slow contact holds
+        # up no key. A key is done at its first holder, stragglers of done keys
+        # are not waited for. Returns {key: (value, holder)} for the keys found
+        found = {}
+        pending = {} # task -> (node, keys, hedge deadline or None once hedged)
+        try:
+            while True:
+                open_keys = [key for key, shortlist in shortlists.items() if key not in found and not shortlist.finished()]
+                if not open_keys: break
+                in_flight = {}
+                for _, keys, deadline in pending.values():
+                    if deadline is None: continue
+                    for key in keys: in_flight[key] = in_flight.get(key, 0) + 1
+                batches = {} # node id -> (node, keys)
+                for key in open_keys:
+                    for node in shortlists[key].next_to_query(self.alpha - in_flight.get(key, 0)):
+                        shortlists[key].mark_pending(node)
+                        batches.setdefault(node.id, (self.DHT.get(node.id) or node, []))[1].append(key)
+                for node, keys in batches.values():
+                    for i in range(0, len(keys), max_batch):
+                        task = asyncio.create_task(ask(node, keys[i:i + max_batch]))
+                        pending[task] = (node, keys[i:i + max_batch], time.monotonic() + node.hedge_delay())
+                if not pending: break
+                deadlines = [deadline for _, _, deadline in pending.values() if deadline is not None]
+                wait_time = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+                done, _ = await asyncio.wait(pending, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node, keys, _ = pending.pop(task)
+                    try: reply = task.result()
+                    except RPC_ERRORS:
+                        for key in keys: shortlists[key].mark_failed(node)
+                        continue
+                    self.add_contact(node)
+                    for key in keys:
+                        new_nodes, value = reply.get(key, ([], None))
+                        if value is not None and key not in found: found[key] = (value, node)
+                        shortlists[key].mark_answered(node, new_nodes)
+                now = time.monotonic()
+                for task, (node, keys, deadline) in pending.items():
+                    if deadline is not None and deadline <= now: pending[task] = (node, keys, None)
+        finally:
+            for task in pending: task.cancel()
+        return found
+
+    async def ask_for_closest_nodes(self, node: NodeContact, target: int) -> list:
+        cid = format(target, '04x')
+        nodes = await self.request(node, {'closest_nodes_request': (self.public_ip, cid)})
+        if not isinstance(nodes, (list, tuple)): raise ValueError(f"{node.ip} sent a malformed closest nodes reply")
+        return [self.from_wire(node) for node in nodes]
+
+    async def ask_for_value(self, node: NodeContact, key: str) -> tuple:
+        response = await self.request(node, {'find_value_request': (self.public_ip, self.CID, key)})
+        return self.value_answer(node, key, response)
+
+    async def ask_for_values(self, node: NodeContact, keys: list) -> dict:
+        # Returns {key: (closer contacts, value or None)} for every key of one
+        # find_value_batch_request, keys held beyond the reply's size get fetched singly
+        response = await self.request(node, {'find_value_batch_request': (self.public_ip, self.CID, keys)})
+        if not isinstance(response, dict): raise ValueError(f"{node.ip} sent a malformed find value batch reply")
+        answers = {}; held = []
+        for key in keys:
+            answer = response.get(key, {'nodes': []})
+            if isinstance(answer, dict) and answer.get('held') is True: held.append(key)
+            else: answers[key] = self.value_answer(node, key, answer)
+        for key, answer in zip(held, await asyncio.gather(*(self.ask_for_value(node, key) for key in held))):
+            answers[key] = answer
+        return answers
+
+    def value_answer(self, node: NodeContact, key: str, answer) -> tuple:
+        # (closer contacts, None) or ([], value), a value not matching its key is refused
+        if not isinstance(answer, dict): raise ValueError(f"{node.ip} sent a malformed find value reply")
+        if 'value' not in answer: return [self.from_wire(node) for node in answer['nodes']], None
+        if not isinstance(answer['value'], str) or content_key(answer['value']) != key:
+            raise ValueError(f"{node.ip} answered {key} with another value")
+        return [], answer['value']
+
+    def store_value(self, key: str, value: str) -> bool:
+        # Only values matching their key are kept, nobody can overwrite a key,
+        # and none once the values would take more than max_stored_bytes
+        if not isinstance(value, str) or value_size(value) > MAX_VALUE_SIZE or content_key(value) != key: return False
+        if key in self.values: return True
+        data = value.encode('utf-8')
+        if self.values.live_bytes + len(data) > self.max_stored_bytes: return False
+        self.values.put(key, data)
+        return True
+
+    def stored_value(self, key: str):
+        try: value = self.values.get(key)
+        except CorruptRecord:
+            self.values.delete(key); return None # the next STORE of it writes a good copy
+        return None if value is None else value.decode('utf-8')
+
+    async def store(self, value: str) -> str:
+        key = content_key(value)
+        if not await self.put(key, value): raise ConnectionError(f"no node stored {key}")
+        return key
+
+    async def put(self, key: str, value: str) -> int:
+        # Sends the value to the k closest nodes at once, we keep a copy ourselves
+        # if we are one of them. Returns how many nodes stored it
+        size = value_size(value)
+        if size > MAX_VALUE_SIZE: raise ValueError(f"value of {key} is larger than {MAX_VALUE_SIZE} bytes")
+        target = key_id(key)
+        closest_nodes = await self.deep_node_search(target, self.DHT.k)
+        stored = 0
+        if len(closest_nodes) < self.DHT.k or self.node_id ^ target < closest_nodes[-1].id ^ target:
+            stored += self.store_value(key, value)
+        replies = await asyncio.gather(*(self.request(node, {'store_request': (self.public_ip, self.CID, key, value)}, size)
+            for node in closest_nodes), return_exceptions=True)
+        for reply in replies:
+            if isinstance(reply, BaseException) and not isinstance(reply, RPC_ERRORS): raise reply
+        return stored + sum(reply is True for reply in replies)
+
+    async def store_object(self, data: str) -> str:
+        # Anything over one chunk is stored chunk by chunk, each under its own key,
+        # with a manifest listing them under the object key
+        if len(data) <= CHUNK_SIZE: return await self.store(data)
+        manifest, chunks = build_manifest(data)
+        slots = asyncio.Semaphore(MAX_PARALLEL_CHUNKS)
+        stored = await asyncio.gather(*(self.put_chunk(slots, key, chunk) for key, chunk in chunks))
+        if not all(stored): raise ConnectionError("no node stored a chunk")
+        return await self.store(manifest)
+
+    async def put_chunk(self, slots: asyncio.Semaphore, key: str, chunk: str) -> int:
+        async with slots: return await self.put(key, chunk)
+
+    async def find_object(self, key: str):
+        # Returns the object stored by store_object or None. Chunks are looked up
+        # CHUNK_LOOKUP_WINDOW at a time with batched FIND_VALUEs, so a large object
+        # streams in from many nodes at once while each contact is asked once per
+        # round. Chunks are checked against their key and a missing one ends the download
+        value = await self.find_value(key)
+        manifest = parse_manifest(value) if value is not None else None
+        if manifest is None: return value
+        chunks = {}
+        for start in range(0, len(manifest['chunks']), CHUNK_LOOKUP_WINDOW):
+            window = manifest['chunks'][start:start + CHUNK_LOOKUP_WINDOW]
+            found = await self.find_values(window)
+            if any(found.get(chunk_key) is None for chunk_key in window): return None
+            chunks.update(found)
+        data = ''.join(chunks[chunk_key] for chunk_key in manifest['chunks'])
+        if len(data) != manifest['size']: raise ValueError(f"object {key} is {len(data)} long, its manifest says {manifest['size']}")
+        return data
+
+    async def find_value(self, key: str):
+        # Returns the value stored under key or None if no node holds it
+        value = self.stored_value(key)
+        if value is not None: return value
+        target = key_id(key)
+        self.DHT.touch(target)
+        closest_nodes, found = await self.iterative_lookup(target, self.DHT.k, key)
+        if found is None: return None
+        self.cache_value(key, found[0], closest_nodes, found[1])
+        return found[0]
+
+    async def find_values(self, keys: list) -> dict:
+        # FIND_VALUE for many keys, returns {key: value or None}. One shortlist
+        # per key, each contact is asked once for all the keys it is a next hop
+        # of. A key leaves the lookup at the first node holding it
+        values = {}; shortlists = {}
+        for key in dict.fromkeys(keys):
+            values[key] = self.stored_value(key)
+            if values[key] is not None: continue
+            target = key_id(key)
+            self.DHT.touch(target)
+            shortlists[key] = Shortlist(target, self.DHT.k, self.get_closest_nodes(target, self.DHT.k), self.node_id)
+
+        found = await self.batched_lookup(shortlists, self.ask_for_values, MAX_BATCH_VALUES)
+        for key, (value, holder) in found.items():
+            values[key] = value
+            self.cache_value(key, value, shortlists[key].result(), holder)
+        return values
+
+    def cache_value(self, key: str, value: str, closest_nodes: list, holder: NodeContact):
+        # The closest node that did not have it keeps a copy for the next lookup
+        for node in closest_nodes:
+            if node.id == holder.id: continue
+            task = asyncio.create_task(self.request(node, {'store_request': (self.public_ip, self.CID, key, value)},
+                value_size(value)))
+            self.background_tasks.add(task); task.add_done_callback(self.cache_stored)
+            break
+
+    def cache_stored(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled(): task.exception() # a failed copy only costs the next lookup a hop
+
+    async def request(self, contact: NodeContact, data: dict, payload=0):
+        # Times out after the peer's own RTO and feeds every answer back into it.
+        # A request carrying payload bytes gets their transfer time on top, its
+        # round trip says more about the link than the peer and is not recorded
+        timeout = contact.rto() + payload / MIN_TRANSFER_RATE
+        try: response, rtt = await self.exchange(contact.ip, data, timeout, contact.port)
+        except asyncio.TimeoutError: contact.record_timeout(); raise
+        if rtt is not None and not payload: contact.record_rtt(rtt)
+        return response
+
+    def get_closest_nodes(self, target: int, amount=4) -> list:
+        if self.contact_index is not None: return self.contact_index.closest(target, amount)
+        return self.DHT.closest(target, amount)
+
+    def to_wire(self, contact: NodeContact) -> tuple:
+        # Contacts learned without a port listen on the default one
+        if contact.port: return (contact.cid(16), contact.ip, contact.port)
+        return (contact.cid(16), contact.ip)
+
+    def from_wire(self, node) -> NodeContact:
+        # A peer may send anything, a contact that is not (16 bit cid, ip[, port]) is rejected
+        if not isinstance(node, (list, tuple)) or len(node) not in (2, 3) or not isinstance(node[0], str) \
+                or len(node[0]) != 4 or not valid_ip(node[1]) or len(node) == 3 and node[2] is not None and not valid_port(node[2]):
+            raise ValueError(f"malformed contact {node!r}")
+        return NodeContact.from_cid(node[0], node[1], node[2] if len(node) > 2 else None)
+
+    def add_node(self, ip: str, cid: str, port=None):
+        self.add_contact(self.from_wire((cid, ip, port)))
+
+    def add_contact(self, contact: NodeContact):
+        is_new = contact.id not in self.DHT
+        if self.contact_index is not None: self.contact_index.add_contact(contact)
+        stale_node = self.DHT.add_contact(contact)
+        if stale_node:
+            task = asyncio.create_task(self.ping_before_evict(stale_node))
+            self.background_tasks.add(task); task.add_done_callback(self.background_tasks.discard)
+        elif is_new and contact.id in self.DHT:
+            print(f"Found Node {contact.ip} in bucket {self.DHT.bucket_for(contact.id)}")
+
+    async def ping(self, contact: NodeContact) -> bool:
+        try:
+            response = await self.request(contact, {'node_info_request': (self.public_ip, self.CID, self.port)})
+            self.observe_address(response, contact.ip)
+            contact.last_seen = time.time()
+            return True
+        except RPC_ERRORS: return False
+
+    async def ping_before_evict(self, stale_node: NodeContact):
+        # The oldest node keeps its slot as long as it still answers
+        alive = await self.ping(stale_node)
+        if not alive and self.contact_index is not None: self.contact_index.remove_contact(stale_node.id)
+        self.DHT.resolve_ping(stale_node.id, alive)
+
+    async def revalidate_contacts(self, contacts: list, patience=1.0):
+        # Contacts of the last run only return to the DHT once they answer again,
+        # each as soon as its ping does. Returns with the first answer, or after
+        # patience seconds without one so the seeds get asked, the other pings
+        # go on in the background instead of holding up the join
+        pings = [asyncio.create_task(self.revalidate_contact(contact)) for contact in contacts]
+        for task in pings: self.background_tasks.add(task); task.add_done_callback(self.background_tasks.discard)
+        try:
+            for answered in asyncio.as_completed(pings, timeout=patience):
+                if await answered: return
+        except asyncio.TimeoutError: pass
+
+    async def revalidate_contact(self, contact: NodeContact) -> bool:
+        if not await self.ping(contact): return False
+        self.add_contact(contact)
+        return True
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.save_snapshot()
+
+    async def compaction_loop(self):
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            if self.values.needs_compaction(): await asyncio.to_thread(self.values.compact)
+
+    def save_snapshot(self):
+        if len(self.DHT): self.DHT.save_snapshot(self.snapshot_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a V2 DHT node")
+    parser.add_argument('--port', type=int, default=60000)
+    parser.add_argument('--bootstrap', action='append', metavar='IP[:PORT]', help="seed node, repeatable (default: 79.230.223.138)")
+    parser.add_argument('--public-ip', help="address peers reach us at (default: discovered)")
+    parser.add_argument('--no-lookup', action='store_true', help="never ask an http service for the public address")
+    parser.add_argument('--blocklist', help="file of ips and CIDR ranges to drop, e.g. WebAppV2/bitchat/ips.txt")
+    parser.add_argument('--codec', choices=CODECS, default='binary')
+    parser.add_argument('--no-udp', action='store_true', help="send every request over TCP")
+    parser.add_argument('--max-stored-bytes', type=int, default=MAX_STORED_BYTES, help="bytes of values kept for the network")
+    args = parser.parse_args()
+
+    FSN = file_system_node(port=args.port, bootstrap_nodes=args.bootstrap or ['79.230.223.138'], wire_codec=args.codec,
+        use_udp=not args.no_udp, blocklist_path=args.blocklist, public_ip=args.public_ip,
+        address_lookup_url=None if args.no_lookup else 'https://api.ipify.org', max_stored_bytes=args.max_stored_bytes)
+    FSN.run()
@@ -108,6 +108,7 @@ class PrepareConversations:
             word_table.write(json.dumps(word_conversations, indent=4))
 
 
-c1 = PrepareConversations()
-# c1.words_lookup_table()
-c1.conversations_order()
\ No newline at end of file
+if __name__ == '__main__':
+    c1 = PrepareConversations()
+    # c1.words_lookup_table()
+    c1.conversations_order()
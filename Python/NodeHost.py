@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import os
+import random
+import weakref
+from AddressDiscovery import AddressDiscovery, local_interface_ip
+from Admission import Admission
+from Blocklist import Blocklist
+from ConnectionPool import ConnectionPool
+from DistributedStorageV2 import file_system_node, RPC_ERRORS, COMPACTION_INTERVAL
+
+class NodeHost:
+    # Runs count file_system_node identities on one event loop, listening on
+    # base_port, base_port + 1, ... They share one connection pool, one address
+    # discovery, one blocklist and one timer: instead of a sleeping bootstrap,
+    # snapshot and compaction task per node, upkeep is scheduled with call_later and at most
+    # max_concurrent_upkeep nodes run theirs at once. Every node after the first
+    # also seeds from the first, so a host forms its own cluster when offline
+    def __init__(self, count: int, base_port: int, bootstrap_nodes: list, state_dir='.', public_ip=None,
+            address_lookup_url='https://api.ipify.org', blocklist_path=None, snapshot_interval=60.0,
+            max_concurrent_upkeep=16, **node_options):
+        self.address_lookup_url = address_lookup_url
+        self.snapshot_interval = snapshot_interval
+        self.upkeep_slots = None # asyncio.Semaphore, created on the loop in start
+        self.max_concurrent_upkeep = max_concurrent_upkeep
+        self.pool = ConnectionPool()
+        self.discovery = AddressDiscovery(public_ip, os.path.join(state_dir, 'address.cache'))
+        blocklist = Blocklist(blocklist_path).start_watching() if blocklist_path else None
+        # A pooled connection may be reused by any node, so is the codec its hello agreed on
+        self.peer_codecs = weakref.WeakKeyDictionary()
+        first_node = f"{local_interface_ip()}:{base_port}"
+        self.nodes = []
+        for port in range(base_port, base_port + count):
+            node = file_system_node(port, list(bootstrap_nodes) + ([first_node] if port != base_port else []),
+                snapshot_path=os.path.join(state_dir, f"dht_{port}.snapshot"),
+                storage_path=os.path.join(state_dir, f"values_{port}"), connection_pool=self.pool,
+                admission=Admission(blocklist=blocklist), address_discovery=self.discovery, address_lookup_url=None, **node_options)
+            node.peer_codecs = self.peer_codecs
+            self.nodes.append(node)
+        self.background_tasks = set()
+
+    def run(self):
+        asyncio.run(self.start())
+
+    async def start(self):
+        self.upkeep_slots = asyncio.Semaphore(self.max_concurrent_upkeep)
+        for node in self.nodes: await node.listen()
+        print(f"Hosting {len(self.nodes)} nodes on ports {self.nodes[0].port}-{self.nodes[-1].port}")
+        loop = asyncio.get_running_loop()
+        # Spread the first round so the first node is not flooded past its rate limit
+        for node in self.nodes: loop.call_later(random.uniform(0, len(self.nodes) / 50), self.start_upkeep, node, True)
+        await asyncio.gather(self.pool.sweep_forever(), self.snapshot_loop(), self.compaction_loop(), self.discover_public_ip(),
+            *(node.server.serve_forever() for node in self.nodes))
+
+    def start_upkeep(self, node: file_system_node, first=False):
+        task = asyncio.create_task(self.upkeep(node, first))
+        self.background_tasks.add(task); task.add_done_callback(self.background_tasks.discard)
+
+    async def upkeep(self, node: file_system_node, first: bool):
+        async with self.upkeep_slots:
+            try:
+                if first: await node.revalidate_contacts(node.snapshot_contacts)
+                wait_time = await node.maintain()
+            except RPC_ERRORS: wait_time = 5.0
+        asyncio.get_running_loop().call_later(wait_time + random.uniform(0, node.refresh_jitter), self.start_upkeep, node)
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            for node in self.nodes: node.save_snapshot()
+
+    async def compaction_loop(self):
+        # One store compacts at a time, so the disk is never shared by several rewrites
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            for node in self.nodes:
+                if node.values.needs_compaction(): await asyncio.to_thread(node.values.compact)
+
+    async def discover_public_ip(self):
+        if not self.address_lookup_url: return
+        known_ip = self.discovery.public_ip
+        await asyncio.to_thread(self.discovery.query_service, self.address_lookup_url)
+        if self.discovery.public_ip != known_ip: print(f"Public address is now {self.discovery.public_ip}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run many V2 DHT nodes in one process")
+    parser.add_argument('count', type=int, help="number of nodes")
+    parser.add_argument('--port', type=int, default=60000, help="port of the first node, the others follow it")
+    parser.add_argument('--bootstrap', action='append', metavar='IP[:PORT]', help="seed node, repeatable (default: 79.230.223.138)")
+    parser.add_argument('--state-dir', default='.', help="where snapshots and the address cache go")
+    parser.add_argument('--public-ip', help="address peers reach us at (default: discovered)")
+    parser.add_argument('--no-lookup', action='store_true', help="never ask an http service for the public address")
+    parser.add_argument('--blocklist', help="file of ips and CIDR ranges to drop, e.g. WebAppV2/bitchat/ips.txt")
+    parser.add_argument('--refresh-jitter', type=float, default=60.0)
+    args = parser.parse_args()
+
+    host = NodeHost(args.count, args.port, args.bootstrap or ['79.230.223.138'], args.state_dir, args.public_ip,
+        None if args.no_lookup else 'https://api.ipify.org', args.blocklist, refresh_jitter=args.refresh_jitter)
+    host.run()
@@ -0,0 +1,82 @@
+import bisect
+from collections import OrderedDict
+import heapq
+import time
+from RoutingTable import NodeContact, RoutingTable
+
+class Shortlist:
+    # State of one iterative lookup: every contact seen so far ordered by its
+    # distance to the target, plus which of them were queried, pending or failed
+    def __init__(self, target: int, k: int, contacts=(), own_id=None):
+        self.target = target
+        self.k = k
+        self.ranked = [] # (distance, contact), closest first
+        self.seen = set() if own_id is None else {own_id}
+        self.pending = set()
+        self.answered = set()
+        self.failed = set()
+        self.add(contacts)
+
+    def add(self, contacts):
+        for contact in contacts:
+            if contact.id in self.seen: continue
+            self.seen.add(contact.id)
+            bisect.insort(self.ranked, (contact.id ^ self.target, contact)) # distances never tie
+
+    def closest(self) -> list:
+        closest_nodes = []
+        for _, contact in self.ranked:
+            if contact.id in self.failed: continue
+            closest_nodes.append(contact)
+            if len(closest_nodes) == self.k: break
+        return closest_nodes
+
+    def next_to_query(self, limit: int) -> list:
+        # Only the k closest live contacts are worth a query
+        if limit <= 0: return []
+        return [contact for contact in self.closest()
+            if contact.id not in self.pending and contact.id not in self.answered][:limit]
+
+    def mark_pending(self, contact: NodeContact):
+        self.pending.add(contact.id)
+
+    def mark_answered(self, contact: NodeContact, contacts: list):
+        self.pending.discard(contact.id); self.answered.add(contact.id)
+        self.add(contacts)
+
+    def mark_failed(self, contact: NodeContact):
+        self.pending.discard(contact.id); self.failed.add(contact.id)
+
+    def finished(self) -> bool:
+        return all(contact.id in self.answered for contact in self.closest())
+
+    def result(self) -> list:
+        return [contact for contact in self.closest() if contact.id in self.answered]
+
+class LookupCache:
+    # Last result per lookup target. An entry expires after ttl seconds or as soon
+    # as the routing table bucket covering its target gains or loses a contact.
+    # Targets that only differ in their nearby_bits lowest bits share one entry
+    def __init__(self, table: RoutingTable, ttl=60.0, nearby_bits=0, max_entries=1024):
+        self.table = table
+        self.ttl = ttl
+        self.nearby_bits = nearby_bits
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (result, amount, expires, bucket, version)
+
+    def get(self, target: int, amount: int):
+        key = target >> self.nearby_bits
+        entry = self.entries.get(key)
+        if entry is None: return None
+        result, cached_amount, expires, bucket, version = entry
+        if expires < time.monotonic() or self.table.bucket_for(target) is not bucket or bucket.version != version:
+            del self.entries[key]; return None
+        if cached_amount < amount: return None
+        self.entries.move_to_end(key)
+        return heapq.nsmallest(amount, result, key=lambda contact: contact.id ^ target)
+
+    def put(self, target: int, amount: int, result: list):
+        bucket = self.table.bucket_for(target)
+        self.entries[target >> self.nearby_bits] = (result, amount, time.monotonic() + self.ttl, bucket, bucket.version)
+        self.entries.move_to_end(target >> self.nearby_bits)
+        if len(self.entries) > self.max_entries: self.entries.popitem(last=False)
@@ -0,0 +1,33 @@
+import hashlib
+import json
+
+CHUNK_SIZE = 256 * 1024 # characters, WebAppV2 images are base64 text
+MANIFEST_HEADER = 'bitchat-manifest/1\n'
+
+def content_key(value: str) -> str:
+    # Same key as generateTextHash in WebAppV2 networking.js
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+def build_manifest(data: str, chunk_size=CHUNK_SIZE) -> tuple:
+    # Returns (manifest text, [(chunk key, chunk)]). The object key is the key of
+    # the manifest, so it vouches for the chunk list and each chunk key for its chunk
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    keys = [content_key(chunk) for chunk in chunks]
+    manifest = {'size': len(data), 'chunk_size': chunk_size, 'chunks': keys}
+    return MANIFEST_HEADER + json.dumps(manifest, separators=(',', ':'), sort_keys=True), list(zip(keys, chunks))
+
+def parse_manifest(value: str):
+    # Returns the manifest of a chunked object, None for a plain value. A
+    # manifest that is not {size: int, chunks: [chunk keys]} raises ValueError
+    if not value.startswith(MANIFEST_HEADER): return None
+    try: manifest = json.loads(value[len(MANIFEST_HEADER):])
+    except RecursionError: raise ValueError("manifest nested too deep") from None
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('chunks'), list) or not manifest['chunks']:
+        raise ValueError("manifest without chunks")
+    if not all(valid_key(key) for key in manifest['chunks']): raise ValueError("manifest lists a malformed chunk key")
+    size = manifest.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0: raise ValueError("manifest without a valid size")
+    return manifest
+
+def valid_key(key) -> bool:
+    return isinstance(key, str) and len(key) == 64 and all(c in '0123456789abcdef' for c in key)
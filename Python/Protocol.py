@@ -0,0 +1,92 @@
+import asyncio
+import json
+import struct
+from BinaryCodec import CodecError
+
+# Every message travels as one frame: payload length, message type, payload
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_JSON = 1
+FRAME_BINARY = 2
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Requests carry ids and addresses, only replies need MAX_FRAME_SIZE
+MAX_REQUEST_FRAME_SIZE = 64 * 1024
+# Offered in the hello that opens a connection, most preferred first
+CODECS = ('binary', 'json')
+
+class FrameError(ValueError):
+    pass
+
+def encode_frame(payload: bytes, kind=FRAME_JSON) -> bytes:
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+def decode_frame(data: bytes) -> tuple:
+    # A datagram holds exactly one frame
+    if len(data) < FRAME_HEADER.size: raise FrameError("datagram is shorter than a frame header")
+    length, kind = FRAME_HEADER.unpack_from(data)
+    if length != len(data) - FRAME_HEADER.size: raise FrameError("frame length does not match the datagram")
+    return kind, data[FRAME_HEADER.size:]
+
+def encode_message(message: dict, codec=None) -> bytes:
+    # Binary whenever a codec was negotiated and knows the message, JSON otherwise
+    if codec is not None:
+        try: return encode_frame(codec.encode(message), FRAME_BINARY)
+        except CodecError: pass
+    return encode_frame(json.dumps(message).encode("utf-8"))
+
+def decode_message(kind: int, payload: bytes, codec=None) -> dict:
+    if kind == FRAME_BINARY and codec is not None: return codec.decode(payload)
+    if kind != FRAME_JSON: raise FrameError(f"unknown message type {kind}")
+    return json.loads(payload.decode("utf-8"))
+
+def choose_codec(offered) -> str:
+    return next((codec for codec in CODECS if codec in offered), 'json')
+
+class FrameDecoder:
+    # Reassembles frames for blocking sockets, feed it whatever recv returned
+    # and it hands back every frame that is complete by now. admit() is asked
+    # once per frame as soon as its header arrived, False ends the stream
+    # before its payload gets buffered
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, codec=None, admit=None):
+        self.max_frame_size = max_frame_size
+        self.codec = codec
+        self.admit = admit
+        self.admitted = False # the header at the start of buffer passed admit
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames, offset = [], 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length, kind = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size: raise FrameError(f"frame of {length} bytes is too large")
+            if not self.admitted:
+                if self.admit is not None and not self.admit(): raise FrameError("frame refused")
+                self.admitted = True
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end: break
+            frames.append((kind, bytes(self.buffer[offset + FRAME_HEADER.size:end])))
+            offset = end; self.admitted = False
+        del self.buffer[:offset]
+        return frames
+
+    def messages(self, data: bytes) -> list:
+        return [decode_message(kind, payload, self.codec) for kind, payload in self.feed(data)]
+
+async def read_frame(reader: asyncio.StreamReader, max_frame_size=MAX_FRAME_SIZE, timeout=None, idle_timeout=None,
+        admit=None) -> tuple:
+    # Returns (message type, payload). The timeout covers the whole frame, with
+    # an idle_timeout the wait for the frame to start is limited by that instead.
+    # admit() is asked once the header arrived, False refuses the frame unread
+    async def read(header=None):
+        length, kind = FRAME_HEADER.unpack(header or await reader.readexactly(FRAME_HEADER.size))
+        if length > max_frame_size: raise FrameError(f"frame of {length} bytes is too large")
+        if admit is not None and not admit(): raise FrameError("frame refused")
+        return kind, await reader.readexactly(length)
+    try:
+        if idle_timeout is None: return await asyncio.wait_for(read(), timeout)
+        header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), idle_timeout)
+        return await asyncio.wait_for(read(header), timeout)
+    except asyncio.IncompleteReadError: raise ConnectionError("connection closed in the middle of a frame")
+
+async def read_message(reader: asyncio.StreamReader, max_frame_size=MAX_FRAME_SIZE, timeout=None, codec=None) -> dict:
+    return decode_message(*await read_frame(reader, max_frame_size, timeout), codec)
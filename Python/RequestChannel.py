@@ -0,0 +1,64 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from itertools import count
+import socket
+from threading import Lock, Thread
+import time
+from Protocol import FrameDecoder, encode_message, MAX_FRAME_SIZE
+
+class RequestChannel:
+    # Many concurrent requests share one connection, each carries a request id
+    # and a reader thread hands the reply with the same id to its future
+    def __init__(self, client: socket.socket, on_close=None, max_frame_size=MAX_FRAME_SIZE, codec=None):
+        self.client = client
+        self.on_close = on_close
+        self.max_frame_size = max_frame_size
+        self.codec = codec
+        self.binary = False # set once the peer agreed to binary in its hello
+        self.pending = {} # request id -> Future
+        self.request_ids = count(1)
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.closed = False
+        self.last_used = time.monotonic()
+        client.settimeout(None)
+        Thread(target=self.read_replies, daemon=True).start()
+
+    def request(self, message: dict, timeout=5.0) -> dict:
+        future = Future()
+        with self.lock:
+            if self.closed: raise ConnectionError("channel is closed")
+            request_id = next(self.request_ids); self.pending[request_id] = future
+            self.last_used = time.monotonic()
+        try:
+            with self.send_lock: self.client.sendall(encode_message(dict(message, requestID=request_id), self.codec if self.binary else None))
+            return future.result(timeout)
+        except FutureTimeout: raise TimeoutError("no reply within timeout")
+        except OSError: self.close(); raise
+        finally:
+            with self.lock: self.pending.pop(request_id, None); self.last_used = time.monotonic()
+
+    def idle(self) -> bool:
+        with self.lock: return not self.pending
+
+    def read_replies(self):
+        decoder = FrameDecoder(self.max_frame_size, self.codec)
+        try:
+            while True:
+                chunk = self.client.recv(65536)
+                if not chunk: break
+                for reply in decoder.messages(chunk):
+                    with self.lock:
+                        future = self.pending.get(reply.pop('requestID', None))
+                        if future and not future.done(): future.set_result(reply)
+        except (OSError, ValueError): pass
+        finally: self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done(): future.set_exception(ConnectionError("connection closed"))
+            self.pending = {}
+        if self.on_close: self.on_close(self.client)
+        else: self.client.close()
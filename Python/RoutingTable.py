@@ -0,0 +1,267 @@
+from collections import OrderedDict
+import heapq
+import math
+import os
+import random
+import socket
+import struct
+import tempfile
+import time
+from threading import RLock
+
+# Snapshot: header, own id, then one fixed size record per contact
+SNAPSHOT_HEADER = struct.Struct('!4sBHI') # magic, version, id_bits, contact count
+SNAPSHOT_CONTACT = struct.Struct('!B16sHdf') # ip version, packed ip, port, last_seen, rtt
+SNAPSHOT_MAGIC = b'BCRT'
+
+class NodeContact:
+    # Ids stay integers inside the node, hex strings only exist on the wire
+    __slots__ = ('id', 'ip', 'port', 'last_seen', 'rtt', 'rttvar')
+
+    def __init__(self, node_id: int, ip: str, port=None, last_seen=0.0, rtt=None):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = last_seen
+        self.rtt = rtt # smoothed round trip time in seconds
+        self.rttvar = None if rtt is None else rtt / 2
+
+    @classmethod
+    def from_cid(cls, cid: str, ip: str, port=None):
+        return cls(int(cid, base=16), ip, port)
+
+    def record_rtt(self, sample: float):
+        # Same smoothing as TCP (RFC 6298)
+        if self.rtt is None:
+            self.rtt = sample; self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+    def record_timeout(self):
+        # Backs the retransmission timeout off until the peer answers again
+        if self.rtt is not None: self.rttvar = self.rttvar * 2 + self.rtt / 4
+
+    def rto(self, default=5.0, min_rto=0.2, max_rto=30.0) -> float:
+        if self.rtt is None: return default
+        return min(max(self.rtt + 4 * self.rttvar, min_rto), max_rto)
+
+    def hedge_delay(self, default=1.0) -> float:
+        # Roughly the 95th percentile of this peer's round trip times
+        if self.rtt is None: return default
+        return self.rtt + 2 * self.rttvar
+
+    def cid(self, id_bits: int) -> str:
+        return format(self.id, f'0{id_bits // 4}x')
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, NodeContact) and self.id == other.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"NodeContact({self.id:x}, {self.ip})"
+
+class KBucket:
+    # Covers every id starting with the depth leading bits of low
+    __slots__ = ('low', 'depth', 'id_bits', 'contacts', 'version', 'last_lookup')
+
+    def __init__(self, low: int, depth: int, id_bits: int):
+        self.low = low
+        self.depth = depth
+        self.id_bits = id_bits
+        self.contacts = OrderedDict() # id -> NodeContact, least recently seen first
+        self.version = 0 # bumped whenever a contact joins or leaves
+        self.last_lookup = -math.inf # time.monotonic() of the last lookup into this range, -inf before the first
+
+    def covers(self, node_id: int) -> bool:
+        return (node_id ^ self.low) >> (self.id_bits - self.depth) == 0
+
+    def random_id(self) -> int:
+        return self.low | random.getrandbits(self.id_bits - self.depth)
+
+    def split(self) -> tuple:
+        high_bit = 1 << (self.id_bits - self.depth - 1)
+        low = KBucket(self.low, self.depth + 1, self.id_bits)
+        high = KBucket(self.low | high_bit, self.depth + 1, self.id_bits)
+        for node_id, contact in self.contacts.items():
+            (high if node_id & high_bit else low).contacts[node_id] = contact
+        low.last_lookup = high.last_lookup = self.last_lookup
+        return low, high
+
+    def __len__(self) -> int:
+        return len(self.contacts)
+
+    def __str__(self) -> str:
+        prefix = format(self.low >> (self.id_bits - self.depth), f'0{self.depth}b') if self.depth else ''
+        return prefix + '*'
+
+class RoutingTable:
+    # Kademlia prefix tree, a full bucket is only split while it covers our own
+    # id or the newcomer would be among our k closest contacts
+    def __init__(self, own_id: int, id_bits: int, k=20):
+        self.own_id = own_id
+        self.id_bits = id_bits
+        self.k = k
+        self.root = KBucket(0, 0, id_bits) # leaves are KBuckets, inner nodes [low, high]
+        self.pending_pings = {} # stale id -> contact waiting for its slot
+        self.lock = RLock()
+
+    @property
+    def buckets(self) -> list:
+        with self.lock:
+            return list(self.bucket_order(0))
+
+    def bucket_for(self, node_id: int) -> KBucket:
+        node, depth = self.root, 0
+        while not isinstance(node, KBucket):
+            node = node[node_id >> (self.id_bits - depth - 1) & 1]; depth += 1
+        return node
+
+    def bucket_order(self, target: int):
+        # Leaves by increasing XOR distance to target, the subtree on the
+        # target's side of every split is always closer than the other one
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if isinstance(node, KBucket): yield node; continue
+            near = target >> (self.id_bits - depth - 1) & 1
+            stack.append((node[1 - near], depth + 1))
+            stack.append((node[near], depth + 1))
+
+    def touch(self, target: int):
+        self.bucket_for(target).last_lookup = time.monotonic()
+
+    def stale_buckets(self, refresh_interval: float) -> list:
+        now = time.monotonic()
+        return [bucket for bucket in self.buckets if now - bucket.last_lookup >= refresh_interval]
+
+    def next_refresh(self, refresh_interval: float) -> float:
+        # Seconds until the first bucket runs out of lookup activity
+        oldest = min(bucket.last_lookup for bucket in self.buckets)
+        return max(oldest + refresh_interval - time.monotonic(), 0.0)
+
+    def can_split(self, bucket: KBucket, contact: NodeContact) -> bool:
+        if bucket.depth >= self.id_bits: return False
+        if bucket.covers(self.own_id): return True
+        closest_nodes = self.closest(self.own_id, self.k)
+        return len(closest_nodes) < self.k or contact.id ^ self.own_id < closest_nodes[-1].id ^ self.own_id
+
+    def split_bucket(self, bucket: KBucket):
+        parent, node, depth = None, self.root, 0
+        while node is not bucket:
+            parent, side = node, bucket.low >> (self.id_bits - depth - 1) & 1
+            node = node[side]; depth += 1
+        children = list(bucket.split())
+        if parent is None: self.root = children
+        else: parent[side] = children
+
+    def add_contact(self, contact: NodeContact):
+        # Returns the least recently seen contact if the bucket is full, the
+        # caller has to ping it and report back through resolve_ping
+        if contact.id == self.own_id: return None
+        with self.lock:
+            bucket = self.bucket_for(contact.id)
+            known = bucket.contacts.get(contact.id)
+            if known:
+                known.ip = contact.ip; known.port = contact.port or known.port
+                known.last_seen = time.time(); bucket.contacts.move_to_end(contact.id)
+                return None
+            while len(bucket) >= self.k and self.can_split(bucket, contact):
+                self.split_bucket(bucket)
+                bucket = self.bucket_for(contact.id)
+            if len(bucket) < self.k:
+                contact.last_seen = contact.last_seen or time.time()
+                bucket.contacts[contact.id] = contact; bucket.version += 1
+                return None
+            stale = next(iter(bucket.contacts.values()))
+            already_pinging = stale.id in self.pending_pings
+            self.pending_pings[stale.id] = contact
+            return None if already_pinging else stale
+
+    def resolve_ping(self, stale_id: int, alive: bool):
+        with self.lock:
+            candidate = self.pending_pings.pop(stale_id, None)
+            if alive: self.mark_seen(stale_id); return
+            self.remove_contact(stale_id)
+            if candidate: self.add_contact(candidate)
+
+    def mark_seen(self, node_id: int):
+        with self.lock:
+            bucket = self.bucket_for(node_id)
+            if node_id in bucket.contacts:
+                bucket.contacts[node_id].last_seen = time.time(); bucket.contacts.move_to_end(node_id)
+
+    def remove_contact(self, node_id: int):
+        with self.lock:
+            bucket = self.bucket_for(node_id)
+            if bucket.contacts.pop(node_id, None): bucket.version += 1
+
+    def get(self, node_id: int):
+        return self.bucket_for(node_id).contacts.get(node_id)
+
+    def contacts(self) -> list:
+        with self.lock:
+            return [contact for bucket in self.bucket_order(0) for contact in bucket.contacts.values()]
+
+    def closest(self, target: int, amount: int) -> list:
+        # Walks the buckets outwards from the target and stops once amount
+        # contacts are found, only the visited buckets are ranked
+        closest_nodes = []
+        with self.lock:
+            for bucket in self.bucket_order(target):
+                if len(closest_nodes) >= amount: break
+                if not bucket.contacts: continue
+                closest_nodes.extend(heapq.nsmallest(amount - len(closest_nodes),
+                    bucket.contacts.values(), key=lambda contact: contact.id ^ target))
+        return closest_nodes
+
+    def save_snapshot(self, path: str):
+        id_size = (self.id_bits + 7) // 8
+        records = []
+        for contact in self.contacts():
+            version = 6 if ':' in contact.ip else 4
+            # A contact that does not fit its record is left out, the snapshot is still written
+            try:
+                packed_ip = socket.inet_pton(socket.AF_INET6 if version == 6 else socket.AF_INET, contact.ip)
+                records.append(contact.id.to_bytes(id_size, 'big') + SNAPSHOT_CONTACT.pack(version, packed_ip,
+                    contact.port or 0, contact.last_seen, math.nan if contact.rtt is None else contact.rtt))
+            except (OSError, TypeError, OverflowError, struct.error): continue
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, self.id_bits, len(records))
+
+        # Write next to the old snapshot and swap it in, a crash never leaves half a file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as snapshot:
+                snapshot.write(header + self.own_id.to_bytes(id_size, 'big') + b''.join(records))
+                snapshot.flush(); os.fsync(snapshot.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path); raise
+
+    def __contains__(self, node_id: int) -> bool:
+        return self.get(node_id) is not None
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+def load_snapshot(path: str):
+    # Returns (own_id, id_bits, contacts) or None if there is no usable snapshot
+    try:
+        with open(path, 'rb') as snapshot: data = snapshot.read()
+        magic, version, id_bits, count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != 1: return None
+        id_size = (id_bits + 7) // 8
+        offset = SNAPSHOT_HEADER.size + id_size
+        own_id = int.from_bytes(data[SNAPSHOT_HEADER.size:offset], 'big')
+        contacts = []
+        for _ in range(count):
+            node_id = int.from_bytes(data[offset:offset + id_size], 'big')
+            ip_version, packed_ip, port, last_seen, rtt = SNAPSHOT_CONTACT.unpack_from(data, offset + id_size)
+            ip = socket.inet_ntop(socket.AF_INET6, packed_ip) if ip_version == 6 else socket.inet_ntop(socket.AF_INET, packed_ip[:4])
+            contacts.append(NodeContact(node_id, ip, port or None, last_seen, None if math.isnan(rtt) else rtt))
+            offset += id_size + SNAPSHOT_CONTACT.size
+        return own_id, id_bits, contacts
+    except (OSError, struct.error, ValueError):
+        return None
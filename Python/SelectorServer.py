@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+import selectors
+import socket
+from threading import Lock
+import time
+from Admission import Admission
+from Protocol import FrameDecoder, encode_message, decode_message, FRAME_BINARY, MAX_REQUEST_FRAME_SIZE
+
+class Connection:
+    __slots__ = ('client', 'ip', 'decoder', 'outbox', 'last_active', 'frame_started', 'closed')
+
+    def __init__(self, client: socket.socket, ip: str, max_frame_size: int, admit=None):
+        self.client = client
+        self.ip = ip
+        self.decoder = FrameDecoder(max_frame_size, admit=admit)
+        self.outbox = bytearray() # replies not yet written, guarded by SelectorServer.lock
+        self.last_active = time.monotonic()
+        self.frame_started = None # time.monotonic() when the incomplete frame in decoder began
+        self.closed = False
+
+class SelectorServer:
+    # One selector thread accepts and reads every connection, complete requests
+    # run on a bounded pool of workers and the selector thread writes their
+    # replies back, so no handler ever holds up accepting or reading. Requests
+    # beyond max_backlog are dropped, the peer's timeout handles them like loss.
+    # A peer over its Admission limits is cut off at the frame header, before
+    # its payload is buffered. A frame has to arrive completely within
+    # request_timeout once it started.
+    # handler(message, peer ip) -> reply or None, replies carry the request's requestID
+    def __init__(self, address: tuple, handler, codec=None, max_workers=16, max_backlog=1024,
+            idle_timeout=120.0, request_timeout=10.0, max_frame_size=MAX_REQUEST_FRAME_SIZE, admission=None):
+        self.address = address
+        self.handler = handler
+        self.codec = codec
+        self.max_backlog = max_backlog
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.admission = admission or Admission()
+        self.max_frame_size = max_frame_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.backlog = 0 # requests queued or running on the workers
+        self.ready = set() # connections whose outbox got filled by a worker
+        self.lock = Lock()
+        self.wakeup, self.wakeup_signal = socket.socketpair()
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address); listener.listen(128); listener.setblocking(False)
+        self.wakeup.setblocking(False); self.wakeup_signal.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, 'accept')
+        self.selector.register(self.wakeup, selectors.EVENT_READ, 'wakeup')
+        last_sweep = time.monotonic()
+        while True:
+            for key, events in self.selector.select(timeout=1.0):
+                if key.data == 'accept': self.accept(listener)
+                elif key.data == 'wakeup': self.flush_ready()
+                else:
+                    if events & selectors.EVENT_READ: self.read(key.data)
+                    if events & selectors.EVENT_WRITE: self.write(key.data)
+            if time.monotonic() - last_sweep >= 1.0:
+                self.close_idle(); last_sweep = time.monotonic()
+
+    def accept(self, listener: socket.socket):
+        while True:
+            try: client, address = listener.accept()
+            except (BlockingIOError, InterruptedError): return
+            if not self.admission.open_connection(address[0]): client.close(); continue
+            client.setblocking(False)
+            connection = Connection(client, address[0], self.max_frame_size, lambda ip=address[0]: self.admission.allow(ip))
+            self.connections.add(connection)
+            self.selector.register(client, selectors.EVENT_READ, connection)
+
+    def read(self, connection: Connection):
+        try: chunk = connection.client.recv(65536)
+        except (BlockingIOError, InterruptedError): return
+        except OSError: self.close(connection); return
+        if not chunk: self.close(connection); return
+        connection.last_active = time.monotonic()
+        try: frames = connection.decoder.feed(chunk)
+        except ValueError: self.close(connection); return
+        if not connection.decoder.buffer: connection.frame_started = None
+        elif frames or connection.frame_started is None: connection.frame_started = connection.last_active
+        for kind, payload in frames:
+            with self.lock:
+                if self.backlog >= self.max_backlog: continue
+                self.backlog += 1
+            self.executor.submit(self.run, connection, kind, payload)
+
+    def run(self, connection: Connection, kind: int, payload: bytes):
+        # Runs on a worker thread
+        try:
+            message = decode_message(kind, payload, self.codec)
+            request_id = message.pop('requestID', None)
+            reply = self.handler(message, connection.ip)
+            if reply is None: return
+            data = encode_message(dict(reply, requestID=request_id), self.codec if kind == FRAME_BINARY else None)
+            with self.lock:
+                if connection.closed: return
+                connection.outbox += data; self.ready.add(connection)
+            try: self.wakeup_signal.send(b'\0')
+            except BlockingIOError: pass # a wakeup is already pending
+        except (ValueError, KeyError, TypeError, IndexError, AttributeError): pass
+        finally:
+            with self.lock: self.backlog -= 1
+
+    def flush_ready(self):
+        try:
+            while self.wakeup.recv(4096): pass
+        except BlockingIOError: pass
+        with self.lock: ready, self.ready = self.ready, set()
+        for connection in ready:
+            if not connection.closed: self.write(connection)
+
+    def write(self, connection: Connection):
+        with self.lock:
+            try: sent = connection.client.send(connection.outbox) if connection.outbox else 0
+            except (BlockingIOError, InterruptedError): sent = 0
+            except OSError: sent = None
+            if sent is not None:
+                del connection.outbox[:sent]
+                pending = bool(connection.outbox)
+        if sent is None: self.close(connection); return
+        connection.last_active = time.monotonic()
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        self.selector.modify(connection.client, events, connection)
+
+    def close_idle(self):
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if connection.frame_started is not None and now - connection.frame_started > self.request_timeout:
+                self.close(connection); continue
+            with self.lock: busy = bool(connection.outbox)
+            if not busy and now - connection.last_active > self.idle_timeout: self.close(connection)
+
+    def close(self, connection: Connection):
+        with self.lock:
+            if connection.closed: return
+            connection.closed = True; connection.outbox.clear()
+        self.connections.discard(connection)
+        self.admission.close_connection(connection.ip)
+        self.selector.unregister(connection.client)
+        connection.client.close()
@@ -0,0 +1,288 @@
+import mmap
+import os
+import struct
+from threading import Thread, Lock
+import time
+import zlib
+
+# Record: crc32 of everything after it, key size, value size, key, value.
+# A delete is a record with TOMBSTONE as its value size and no value
+RECORD = struct.Struct('!IHI')
+TOMBSTONE = 0xFFFFFFFF
+# Hint entry: value offset, value size, key size, key. A hint file ends with the
+# size of the data file it describes and the crc32 of everything before
+HINT = struct.Struct('!QIH')
+HINT_TRAILER = struct.Struct('!QI')
+MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+class CorruptRecord(ValueError):
+    pass
+
+class Segment:
+    # One data file. Sealed segments are read through a memory map and close
+    # their own descriptor, the map holds the only one left. The active
+    # segment is read with pread as it keeps growing
+    def __init__(self, segment_id: int, path: str, merged=False):
+        self.id = segment_id
+        self.path = path
+        self.merged = merged
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        self.dead = 0 # bytes of records that were overwritten or deleted since
+
+    def read(self, offset: int, size: int) -> bytes:
+        if self.map is not None: return self.map[offset:offset + size]
+        return os.pread(self.fd, size, offset) if self.fd is not None else b''
+
+    def seal(self):
+        if self.size: self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        os.close(self.fd); self.fd = None
+
+    def unseal(self):
+        # Makes a sealed segment writable again, the last one on startup
+        self.close_map()
+        if self.fd is None: self.fd = os.open(self.path, os.O_RDWR)
+
+    def close_map(self):
+        if self.map is not None: self.map.close(); self.map = None
+
+    def close(self):
+        self.close_map()
+        if self.fd is not None: os.close(self.fd); self.fd = None
+
+    def hint_path(self) -> str:
+        return self.path.removesuffix('.tmp') + '.hint'
+
+class ValueStore:
+    # Bitcask style key/value store in directory path. Every write is appended
+    # to the active segment and the in-memory index maps each key to
+    # (segment id, value offset, value size), so a read is one lookup and one
+    # copy out of a memory map. Full segments are sealed with a hint file that
+    # rebuilds their part of the index without reading the values. compact
+    # rewrites the live records of all sealed segments into merged segments,
+    # which are replayed before the regular ones on startup
+    def __init__(self, path: str, max_segment_size=MAX_SEGMENT_SIZE, sync=False, compact_ratio=0.5,
+            compact_min_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_segment_size = max_segment_size
+        self.sync = sync # fsync every write instead of leaving it to the page cache
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.index = {} # key -> (segment id, value offset, value size)
+        self.live_bytes = 0 # sum of the value sizes in index
+        self.segments = {} # id -> Segment
+        self.next_id = 1
+        self.active = None
+        self.active_hints = [] # (key, value offset, value size) written to the active segment
+        self.lock = Lock()
+        self.compacting = Lock()
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def segment_path(self, segment_id: int, merged=False) -> str:
+        return os.path.join(self.path, f"{segment_id:09d}.{'merged' if merged else 'data'}")
+
+    def load(self):
+        names = set(os.listdir(self.path))
+        for name in names:
+            # Leftovers of a compaction that never finished
+            if name.endswith('.tmp') or name.endswith('.hint') and name[:-5] not in names:
+                os.remove(os.path.join(self.path, name))
+        regular = sorted(int(name[:-5]) for name in names if name.endswith('.data'))
+        merged = sorted(int(name[:-7]) for name in names if name.endswith('.merged'))
+        self.next_id = max(regular + merged, default=0) + 1
+        # Merged segments only hold records older than every regular segment left
+        for segment_id in merged: self.load_segment(Segment(segment_id, self.segment_path(segment_id, True), True))
+        for segment_id in regular: entries = self.load_segment(Segment(segment_id, self.segment_path(segment_id)))
+        if not regular or self.segments[regular[-1]].size >= self.max_segment_size: self.roll()
+        else:
+            self.active = self.segments[regular[-1]]; self.active.unseal()
+            self.active_hints = entries
+
+    def load_segment(self, segment: Segment) -> list:
+        self.segments[segment.id] = segment
+        entries = self.read_hints(segment)
+        if entries is None: entries = self.scan(segment)
+        for key, offset, size in entries:
+            key_size = len(key.encode())
+            self.forget(key, key_size)
+            if size == TOMBSTONE: segment.dead += RECORD.size + key_size
+            else: self.index[key] = (segment.id, offset, size); self.live_bytes += size
+        segment.seal()
+        return entries
+
+    def read_hints(self, segment: Segment):
+        # A hint file describing another size of its data file is stale, the data gets scanned
+        try:
+            with open(segment.hint_path(), 'rb') as hint_file: data = hint_file.read()
+        except OSError: return None
+        if len(data) < HINT_TRAILER.size: return None
+        data_size, crc = HINT_TRAILER.unpack_from(data, len(data) - HINT_TRAILER.size)
+        if data_size != segment.size or zlib.crc32(data[:-4]) != crc: return None
+        entries = []; position = 0
+        while position < len(data) - HINT_TRAILER.size:
+            offset, size, key_size = HINT.unpack_from(data, position); position += HINT.size
+            entries.append((data[position:position + key_size].decode(), offset, size)); position += key_size
+        return entries
+
+    def scan(self, segment: Segment) -> list:
+        # Reads every record, a torn or corrupt tail is cut off
+        entries = []; position = 0
+        if not segment.size: return entries
+        with mmap.mmap(segment.fd, segment.size, access=mmap.ACCESS_READ) as data:
+            while position + RECORD.size <= segment.size:
+                crc, key_size, value_size = RECORD.unpack_from(data, position)
+                end = position + RECORD.size + key_size + (0 if value_size == TOMBSTONE else value_size)
+                if end > segment.size or zlib.crc32(data[position + 4:end]) != crc: break
+                key = data[position + RECORD.size:position + RECORD.size + key_size].decode()
+                entries.append((key, position + RECORD.size + key_size, value_size))
+                position = end
+        if position < segment.size:
+            os.ftruncate(segment.fd, position); segment.size = position
+        return entries
+
+    def write_hints(self, segment: Segment, entries: list):
+        data = b''.join(HINT.pack(offset, size, len(key.encode())) + key.encode() for key, offset, size in entries)
+        data += segment.size.to_bytes(8, 'big')
+        temp_path = segment.hint_path() + '.tmp'
+        with open(temp_path, 'wb') as hint_file: hint_file.write(data + zlib.crc32(data).to_bytes(4, 'big'))
+        os.replace(temp_path, segment.hint_path())
+
+    def new_id(self) -> int:
+        segment_id = self.next_id; self.next_id += 1
+        return segment_id
+
+    def roll(self):
+        # Seals the active segment and starts a new one, caller holds the lock or is loading
+        if self.active is not None:
+            os.fsync(self.active.fd)
+            self.write_hints(self.active, self.active_hints)
+            self.active.seal()
+        segment_id = self.new_id()
+        self.active = self.segments[segment_id] = Segment(segment_id, self.segment_path(segment_id))
+        self.active_hints = []
+
+    def forget(self, key: str, key_size: int):
+        # The record key pointed at is dead from now on
+        entry = self.index.pop(key, None)
+        if entry is None: return
+        self.segments[entry[0]].dead += RECORD.size + key_size + entry[2]
+        self.live_bytes -= entry[2]
+
+    def append(self, key: str, value) -> tuple:
+        key_bytes = key.encode()
+        body = RECORD.pack(0, len(key_bytes), TOMBSTONE if value is None else len(value))[4:] + key_bytes + (value or b'')
+        record = zlib.crc32(body).to_bytes(4, 'big') + body
+        if self.active.size + len(record) > self.max_segment_size and self.active.size: self.roll()
+        offset = self.active.size
+        os.pwrite(self.active.fd, record, offset)
+        if self.sync: os.fsync(self.active.fd)
+        self.active.size += len(record)
+        value_offset = offset + RECORD.size + len(key_bytes)
+        self.active_hints.append((key, value_offset, TOMBSTONE if value is None else len(value)))
+        self.forget(key, len(key_bytes))
+        return self.active.id, value_offset
+
+    def put(self, key: str, value: bytes):
+        with self.lock:
+            segment_id, offset = self.append(key, value)
+            self.index[key] = (segment_id, offset, len(value)); self.live_bytes += len(value)
+
+    def delete(self, key: str) -> bool:
+        with self.lock:
+            if key not in self.index: return False
+            self.append(key, None)
+            self.active.dead += RECORD.size + len(key.encode()) # a tombstone is dead once written
+            return True
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None: return default
+            segment_id, offset, size = entry
+            key_size = len(key.encode())
+            record = self.segments[segment_id].read(offset - key_size - RECORD.size, RECORD.size + key_size + size)
+        if zlib.crc32(record[4:]) != int.from_bytes(record[:4], 'big'):
+            raise CorruptRecord(f"record of {key} in segment {segment_id} fails its crc")
+        return record[RECORD.size + key_size:]
+
+    def size(self, key: str):
+        # Size of the value stored under key without reading it, None if there is none
+        entry = self.index.get(key)
+        return None if entry is None else entry[2]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> list:
+        with self.lock: return list(self.index)
+
+    def needs_compaction(self) -> bool:
+        sealed = [segment for segment in self.segments.values() if segment is not self.active]
+        dead = sum(segment.dead for segment in sealed)
+        return dead >= self.compact_min_bytes and dead >= self.compact_ratio * sum(segment.size for segment in sealed)
+
+    def compact(self) -> bool:
+        # Copies the live records of every sealed segment into new merged
+        # segments, then drops the old files. Writes go on meanwhile, a key
+        # written during the copy keeps its new record
+        with self.compacting:
+            with self.lock:
+                self.roll()
+                inputs = [segment for segment in self.segments.values() if segment is not self.active]
+                input_ids = {segment.id for segment in inputs}
+                live = [(key, entry) for key, entry in self.index.items() if entry[0] in input_ids]
+            if not inputs: return False
+            outputs = []; moved = []; hints = []; output = None
+            for key, (segment_id, offset, size) in sorted(live, key=lambda item: item[1][:2]):
+                key_size = len(key.encode())
+                record = self.segments[segment_id].read(offset - key_size - RECORD.size, RECORD.size + key_size + size)
+                if output is None or output.size + len(record) > self.max_segment_size:
+                    if output is not None: self.finish_merged(output, hints)
+                    with self.lock: output_id = self.new_id()
+                    output = Segment(output_id, self.segment_path(output_id, True) + '.tmp', True)
+                    outputs.append(output); hints = []
+                os.pwrite(output.fd, record, output.size)
+                new_entry = (output.id, output.size + RECORD.size + key_size, size)
+                hints.append((key, new_entry[1], size)); moved.append((key, (segment_id, offset, size), new_entry))
+                output.size += len(record)
+            if output is not None: self.finish_merged(output, hints)
+            with self.lock:
+                for output in outputs:
+                    final_path = output.path.removesuffix('.tmp')
+                    os.replace(output.path, final_path); output.path = final_path
+                    output.seal(); self.segments[output.id] = output
+                for key, old_entry, new_entry in moved:
+                    if self.index.get(key) == old_entry: self.index[key] = new_entry
+                    else: self.segments[new_entry[0]].dead += RECORD.size + len(key.encode()) + new_entry[2]
+                for segment in inputs: del self.segments[segment.id]
+            # Older merged segments go first: after a crash in between, the regular
+            # inputs left replay after the new merged segments and change nothing
+            for segment in sorted(inputs, key=lambda segment: not segment.merged):
+                segment.close(); os.remove(segment.path)
+                try: os.remove(segment.hint_path())
+                except OSError: pass
+            return True
+
+    def finish_merged(self, output: Segment, hints: list):
+        os.fsync(output.fd)
+        self.write_hints(output, hints)
+
+    def compact_forever(self, interval: float):
+        while True:
+            time.sleep(interval)
+            if self.needs_compaction(): self.compact()
+
+    def start_compacting(self, interval=60.0):
+        Thread(target=self.compact_forever, args=(interval,), daemon=True).start()
+        return self
+
+    def close(self):
+        with self.lock:
+            os.fsync(self.active.fd)
+            self.write_hints(self.active, self.active_hints)
+            for segment in self.segments.values(): segment.close()
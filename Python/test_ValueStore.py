@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from ValueStore import ValueStore, CorruptRecord
+
+class ValueStoreTest(unittest.TestCase):
+    # Stores are left open without close() to stand in for a crash
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            for segment in store.segments.values(): segment.close()
+        self.directory.cleanup()
+
+    def open(self, **options) -> ValueStore:
+        store = ValueStore(self.path, **options); self.stores.append(store)
+        return store
+
+    def files(self, suffix: str) -> list:
+        return sorted(name for name in os.listdir(self.path) if name.endswith(suffix))
+
+    def test_put_get_delete(self):
+        store = self.open()
+        store.put('a', b'one'); store.put('b', b'two'); store.put('a', b'three')
+        self.assertEqual(store.get('a'), b'three')
+        self.assertEqual(store.size('b'), 3)
+        self.assertTrue(store.delete('b'))
+        self.assertFalse(store.delete('b'))
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.keys(), ['a'])
+        self.assertEqual(store.live_bytes, 5)
+
+    def test_reopen_after_close_reads_hints(self):
+        store = self.open(max_segment_size=128)
+        for i in range(20): store.put(f'key{i}', b'x' * i)
+        store.delete('key3'); store.close()
+        self.assertTrue(self.files('.hint'))
+        reopened = self.open(max_segment_size=128)
+        self.assertEqual(len(reopened), 19)
+        self.assertIsNone(reopened.get('key3'))
+        self.assertEqual(reopened.get('key19'), b'x' * 19)
+        self.assertEqual(reopened.live_bytes, sum(range(20)) - 3)
+
+    def test_reopen_after_crash_scans(self):
+        store = self.open()
+        store.put('a', b'one'); store.put('b', b'two'); store.delete('a')
+        reopened = self.open()
+        self.assertIsNone(reopened.get('a'))
+        self.assertEqual(reopened.get('b'), b'two')
+
+    def test_stale_hint_is_ignored(self):
+        store = self.open()
+        store.put('a', b'one'); store.close()
+        store = self.open()
+        store.put('b', b'two') # the active segment grows past its hint file
+        reopened = self.open()
+        self.assertEqual(reopened.get('a'), b'one')
+        self.assertEqual(reopened.get('b'), b'two')
+
+    def test_torn_tail_is_cut_off(self):
+        store = self.open()
+        store.put('a', b'one'); store.put('b', b'two')
+        data_path = os.path.join(self.path, self.files('.data')[-1])
+        size = os.path.getsize(data_path)
+        os.truncate(data_path, size - 2)
+        reopened = self.open()
+        self.assertEqual(reopened.get('a'), b'one')
+        self.assertNotIn('b', reopened)
+        reopened.put('c', b'three')
+        self.assertEqual(self.open().get('c'), b'three')
+
+    def test_corrupt_record_raises(self):
+        store = self.open()
+        store.put('a', b'one')
+        data_path = os.path.join(self.path, self.files('.data')[-1])
+        with open(data_path, 'r+b') as data_file:
+            data_file.seek(-1, os.SEEK_END); data_file.write(b'!')
+        with self.assertRaises(CorruptRecord): store.get('a')
+
+    def test_compact_keeps_live_records(self):
+        store = self.open(max_segment_size=128, compact_min_bytes=0)
+        for i in range(30): store.put(f'key{i}', b'v' * 10)
+        for i in range(0, 30, 2): store.delete(f'key{i}')
+        store.put('key1', b'new')
+        self.assertTrue(store.needs_compaction())
+        self.assertTrue(store.compact())
+        self.assertTrue(self.files('.merged'))
+        self.assertFalse(self.files('.tmp'))
+        self.assertEqual(len(store), 15)
+        self.assertEqual(store.get('key1'), b'new')
+        self.assertEqual(store.get('key29'), b'v' * 10)
+        self.assertEqual(store.live_bytes, 14 * 10 + 3)
+
+    def test_reopen_after_compact_replays_merged_first(self):
+        store = self.open(max_segment_size=128, compact_min_bytes=0)
+        for i in range(30): store.put(f'key{i}', b'v' * 10)
+        store.compact()
+        store.put('key5', b'newer'); store.delete('key6')
+        reopened = self.open(max_segment_size=128)
+        self.assertEqual(reopened.get('key5'), b'newer')
+        self.assertNotIn('key6', reopened)
+        self.assertEqual(reopened.get('key7'), b'v' * 10)
+        self.assertEqual(len(reopened), 29)
+
+    def test_leftover_compaction_files_are_removed(self):
+        store = self.open()
+        store.put('a', b'one'); store.close()
+        open(os.path.join(self.path, '000000099.merged.tmp'), 'wb').close()
+        open(os.path.join(self.path, '000000098.data.hint'), 'wb').close()
+        reopened = self.open()
+        self.assertFalse(self.files('.tmp'))
+        self.assertNotIn('000000098.data.hint', os.listdir(self.path))
+        self.assertEqual(reopened.get('a'), b'one')
+
+if __name__ == '__main__':
+    unittest.main()